@@ -0,0 +1,63 @@
+"""Compares the neighbors search backends of the interpolation models.
+
+Usage: python benchmarks/bench_neighbors.py
+"""
+
+import time
+from typing import Callable, Dict
+
+import numpy as np
+
+from in_silico_fate_mapping.fast_radius_regression import FastRadiusRegressor
+
+
+def _tracks_frame(
+    n_tracks: int, dim: int, rng: np.random.Generator
+) -> Dict[str, np.ndarray]:
+    """Consecutive frames of random walk tracks and advected samples queries"""
+    X = rng.uniform(0, 1000, size=(n_tracks, dim))
+    Y = X + rng.normal(scale=2.0, size=X.shape)
+    queries = np.repeat(X[: n_tracks // 10], 25, axis=0)
+    queries += rng.normal(scale=1.0, size=queries.shape)
+    return {"X": X, "Y": Y, "queries": queries}
+
+
+def _timeit(func: Callable, repeats: int = 3) -> float:
+    """Best execution time of `func`"""
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    rng = np.random.default_rng(42)
+    print(
+        f"{'dim':>3} {'tracks':>8} {'radius':>6} {'backend':>8} {'fit (s)':>8} {'predict (s)':>11}"
+    )
+    for dim in (2, 3):
+        for n_tracks in (10_000, 100_000):
+            frame = _tracks_frame(n_tracks, dim, rng)
+            for radius in (10.0, 25.0):
+                for backend in ("kd_tree", "ckdtree", "grid"):
+                    model = FastRadiusRegressor(
+                        radius=radius, weights="distance", algorithm=backend
+                    )
+                    fit_time = _timeit(
+                        lambda: model.fit(frame["X"], frame["Y"])
+                    )
+                    # first query builds the grid cells
+                    model.predict(frame["queries"][:1])
+                    predict_time = _timeit(
+                        lambda: model.predict(frame["queries"])
+                    )
+                    print(
+                        f"{dim:>3} {n_tracks:>8} {radius:>6} {backend:>8} "
+                        f"{fit_time:>8.3f} {predict_time:>11.3f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
+import tempfile
+from pathlib import Path
 from typing import Tuple
 
 import numpy as np
+import pytest
+import zarr
 
-from in_silico_fate_mapping.divergence import Divergence
+from in_silico_fate_mapping.divergence import (
+    Divergence,
+    _init_worker,
+    _OnlineMoments,
+)
 
 
 def _random_tracks(
@@ -107,6 +115,148 @@ def test_simple_divergence(length: int = 100, display: bool = False) -> None:
     )  # assuming it should be at least 3 times more diverse
 
 
+@pytest.mark.parametrize("sigma", [0.1, 1.0])
+def test_jump_divergence(sigma: float) -> None:
+    disk1, disk2, mask, tracks = _simple_divergence_data()
+    horizons = [8, 16, 32, 64, None]
+
+    expected = Divergence(tracks, radius=5, sigma=sigma).multi_horizon(
+        mask, 0, horizons
+    )
+    div = Divergence(tracks, radius=5, sigma=sigma, jumps=True)
+    divergence = div.multi_horizon(mask, 0, horizons)
+
+    # jumps are stepwise realizations, only the sampling noise differs
+    for disk in (disk1, disk2):
+        assert np.allclose(
+            divergence[:, disk].mean(axis=1),
+            expected[:, disk].mean(axis=1),
+            rtol=0.5 if sigma < 1 else 0.15,
+        )
+
+    # full horizon, converged samples of the first disk share a few realizations
+    div1 = divergence[-1, disk1].mean()
+    div2 = divergence[-1, disk2].mean()
+    assert 3 * div1 < div2 if sigma < 1 else div2 < div1
+    assert np.isclose(div2, expected[-1, disk2].mean(), rtol=0.15)
+
+    # tables are reused by later calls
+    assert np.array_equal(div.multi_horizon(mask, 0, horizons), divergence)
+
+
+def test_tiled_divergence() -> None:
+    disk1, disk2, mask, tracks = _simple_divergence_data()
+    expected = Divergence(tracks, radius=5)(mask, 0)
+
+    div = Divergence(tracks, radius=5, tile_shape=(50, 40))
+    assert len(list(div._tiles(mask.shape))) == 12
+
+    out = zarr.zeros(mask.shape, chunks=(50, 40), dtype=np.float32)
+    divergence = div(mask, 0, out=out)
+    assert divergence is out
+
+    divergence = divergence[:]
+    assert np.all(divergence[~mask] == 0)
+    assert 3 * divergence[disk1].mean() < divergence[disk2].mean()
+
+    # each tile draws its own noise stream, results only match statistically
+    assert np.isclose(
+        divergence[disk2].mean(), expected[disk2].mean(), rtol=0.2
+    )
+
+
+@pytest.mark.parametrize("jumps", [False, True])
+def test_parallel_divergence(jumps: bool) -> None:
+    _, _, mask, tracks = _simple_divergence_data()
+
+    # more tiles than the in flight window of 2 * n_processes
+    expected = Divergence(
+        tracks, radius=5, tile_shape=(32, 64), jumps=jumps
+    ).multi_horizon(mask, 0, [16, None])
+    div = Divergence(
+        tracks, radius=5, tile_shape=(32, 64), jumps=jumps, n_processes=2
+    )
+    divergence = div.multi_horizon(mask, 0, [16, None])
+
+    # tiles noise is seeded, results must match the sequential ones
+    assert np.allclose(divergence, expected)
+
+    # jump tables are shared with the workers
+    worker, directory, jump_slices = div._worker_state(
+        Path(tempfile.mkdtemp()), div.time_iter(0)
+    )
+    assert len(worker._jumps) == 0
+    assert len(jump_slices) == (len(div._jumps) if jumps else 0)
+    _init_worker(worker, directory, jump_slices)
+    for key, table in div._jumps.items():
+        assert np.array_equal(worker._jumps[key].ends, table.ends)
+    _, segments = div._segments(0, [16, None])
+    tile = worker._tile_divergence(mask[:32, :64], [0, 0], 0, segments, 0)
+    assert np.allclose(tile, expected[:, :32, :64])
+
+    # workers advecting with jumps only read the tables
+    if jumps:
+        assert len(worker._models) == 0
+
+
+def test_tiles_noise() -> None:
+    disk1, disk2, mask, tracks = _simple_divergence_data()
+    div = Divergence(tracks, radius=5, sigma=1)
+    _, segments = div._segments(0, [None])
+    coords = np.asarray(np.nonzero(disk1)).T
+
+    # tiles with the same voxels are sampled with different noise
+    first = div._spread(coords, 0, segments, tile_index=0)
+    assert np.array_equal(first, div._spread(coords, 0, segments, 0))
+    assert not np.allclose(first, div._spread(coords, 0, segments, 1))
+
+
+def test_online_moments() -> None:
+    rng = np.random.default_rng(42)
+    samples = rng.normal(size=(10, 23, 3))
+
+    moments = _OnlineMoments((10, 3))
+    for start in range(0, 23, 5):
+        moments.update(samples[:, start : start + 5])
+
+    assert np.allclose(moments.mean, samples.mean(axis=1))
+    assert np.allclose(moments.var, samples.var(axis=1))
+
+
+@pytest.mark.parametrize("statistic", ["std", "rms", "displacement"])
+def test_divergence_passes(statistic: str) -> None:
+    disk1, disk2, mask, tracks = _simple_divergence_data()
+
+    expected = Divergence(tracks, radius=5, statistic=statistic)(mask, 0)
+    div = Divergence(tracks, radius=5, samples_per_pass=5, statistic=statistic)
+    divergence = div(mask, 0)
+
+    # passes are sampled with different noise
+    assert np.isclose(
+        divergence[disk2].mean(), expected[disk2].mean(), rtol=0.2
+    )
+
+    div.statistic = "median"
+    with pytest.raises(ValueError):
+        div(mask, 0)
+
+
+def test_multi_horizon() -> None:
+    _, _, mask, tracks = _simple_divergence_data()
+    div = Divergence(tracks, radius=5, tile_shape=(64, 64))
+
+    horizons = [10, 25, 50, None]
+    divergence = div.multi_horizon(mask, 0, horizons)
+    assert divergence.shape == (len(horizons),) + mask.shape
+
+    # noise stream is shared, horizons match independent runs
+    for result, max_length in zip(divergence, horizons):
+        assert np.allclose(result, div(mask, 0, max_length))
+
+    with pytest.raises(ValueError):
+        div.multi_horizon(mask, 0, [25, 10])
+
+
 if __name__ == "__main__":
     # _simple_divergence_data(display=True)
     test_simple_divergence(display=False)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import RadiusNeighborsRegressor
+
+from in_silico_fate_mapping.fast_radius_regression import (
+    _PAIR_NBYTES,
+    FastRadiusRegressor,
+)
+
+
+@pytest.mark.parametrize("weights", ["uniform", "distance"])
+def test_sklearn_equivalence(weights: str) -> None:
+    rng = np.random.default_rng(42)
+    X = rng.uniform(0, 100, size=(500, 3))
+    y = rng.uniform(0, 100, size=(500, 3))
+    queries = rng.uniform(0, 100, size=(1000, 3))
+
+    expected = (
+        RadiusNeighborsRegressor(radius=10, weights=weights)
+        .fit(X, y)
+        .predict(queries)
+    )
+    result = FastRadiusRegressor(radius=10, weights=weights).fit(X, y)
+
+    with pytest.warns(UserWarning, match="no neighbors"):
+        result = result.predict(queries)
+
+    assert np.allclose(result, expected, equal_nan=True)
+
+
+def test_memory_bounded_predict() -> None:
+    rng = np.random.default_rng(42)
+    X = rng.uniform(0, 100, size=(500, 3))
+    y = rng.uniform(0, 100, size=(500, 3))
+    queries = rng.uniform(0, 100, size=(10000, 3))
+
+    model = FastRadiusRegressor(radius=25, weights="distance").fit(X, y)
+    expected = model.predict(queries)
+
+    # a few neighbor pairs per chunk
+    model.max_memory = 1000
+    assert np.allclose(model.predict(queries), expected)
+
+    # threaded radius search
+    model.n_jobs = 4
+    assert np.allclose(model.predict(queries), expected)
+
+
+def test_first_chunk_budget(monkeypatch: pytest.MonkeyPatch) -> None:
+    rng = np.random.default_rng(42)
+    X = rng.uniform(0, 100, size=(500, 3))
+    y = rng.uniform(0, 100, size=(500, 3))
+    queries = rng.uniform(0, 100, size=(10000, 3))
+
+    # every training sample is a neighbor of every query
+    model = FastRadiusRegressor(radius=1000, max_memory=2**20).fit(X, y)
+    expected = model.predict(queries)
+
+    chunks = []
+    radius_pairs = model._radius_pairs
+
+    def _record(X: np.ndarray):
+        chunks.append(len(X))
+        return radius_pairs(X)
+
+    monkeypatch.setattr(model, "_radius_pairs", _record)
+    assert np.allclose(model.predict(queries), expected)
+    assert max(chunks) * len(X) * _PAIR_NBYTES <= model.max_memory
@@ -1,24 +1,55 @@
-from typing import Any, Callable
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
 
 import numpy as np
 import pandas as pd
 import pytest
+import zarr
 
-from in_silico_fate_mapping.fate_mapping import FateMapping
+from in_silico_fate_mapping import fate_mapping
+from in_silico_fate_mapping.fate_mapping import INDEX_CACHE_SIZE, FateMapping
 
 
-@pytest.mark.parametrize("attr,value", [("reverse", True), ("radius", 5)])
-def test_lazy_fit(attr: str, value: Any, line: np.ndarray) -> None:
+def test_lazy_fit(line: np.ndarray) -> None:
     fate_map = FateMapping(data=line, reverse=True, radius=7, n_samples=5)
     assert not fate_map._fitted
 
     fate_map(line[0, 1:])
     assert fate_map._fitted
 
-    setattr(fate_map, attr, value)
+    fate_map.data = line
     assert not fate_map._fitted
 
 
+def test_data_attr(line: np.ndarray) -> None:
+    fate_map = FateMapping(data=line)
+
+    # only the indexed detections are kept, tracks are compared by their hash
+    assert not hasattr(fate_map, "_data")
+    assert fate_map._data_hash == fate_map._hash_data(line.copy())
+
+    other = line.copy()
+    other[0, -1] += 1
+    assert fate_map._data_hash != fate_map._hash_data(other)
+
+    data = fate_map.data
+    assert list(data.columns) == ["TrackID", "t", "z", "y", "x"]
+    assert data["TrackID"].dtype == np.int32
+    order = np.argsort(line[:, 1], kind="stable")
+    assert np.allclose(data.values, line[order])
+
+    # the rebuilt data round-trips
+    next_rows = fate_map._next_rows.copy()
+    fate_map.data = fate_map.data
+    assert np.allclose(fate_map.data.values, data.values)
+    assert np.array_equal(fate_map._next_rows, next_rows)
+
+    fate_map.data = None
+    assert fate_map.data is None
+
+
 def test_simple_reconstruction(
     line_factory: Callable,
     n_samples: int = 25,
@@ -68,6 +99,267 @@ def test_weights_attr(line: np.ndarray) -> None:
         assert m.weights == "uniform"
 
 
+def test_radius_attr(line: np.ndarray) -> None:
+    fate_map = FateMapping(data=line, radius=7, n_samples=5)
+    fate_map._fit()
+    models = dict(fate_map._models)
+
+    fate_map.radius = 5
+    assert fate_map._fitted
+    for t, m in fate_map._models.items():
+        assert m is models[t]
+        assert m.radius == 5
+
+    expected = FateMapping(data=line, radius=5, n_samples=5)
+    assert np.allclose(fate_map(line[0, 1:]), expected(line[0, 1:]))
+
+
+def test_reverse_attr(line: np.ndarray) -> None:
+    fate_map = FateMapping(data=line, radius=5, n_samples=5)
+    fate_map._fit()
+    models = dict(fate_map._models)
+
+    fate_map.reverse = True
+    assert fate_map._fitted
+    source = line[line[:, 1] == 25][0, 1:]
+    tracks = fate_map(source)
+
+    for t, m in fate_map._models.items():
+        assert m is models[t]
+
+    assert tracks[:, 1].min() == 0
+    assert tracks[:, 1].max() == 25
+
+
+@pytest.mark.parametrize("backend", ["ckdtree", "kd_tree", "brute", "grid"])
+def test_backends(line: np.ndarray, backend: str) -> None:
+    expected = FateMapping(data=line, radius=5, n_samples=5, sigma=0.5)
+    fate_map = FateMapping(
+        data=line, radius=5, n_samples=5, sigma=0.5, backend=backend
+    )
+    assert np.allclose(fate_map(line[0, 1:]), expected(line[0, 1:]))
+
+
+def test_float32(line: np.ndarray) -> None:
+    expected = FateMapping(data=line, radius=5, n_samples=5)
+    fate_map = FateMapping(data=line, radius=5, n_samples=5, dtype=np.float32)
+    tracks = fate_map(line[0, 1:])
+
+    assert tracks.dtype == np.float32
+    for m in fate_map._models.values():
+        assert m._fit_X.dtype == np.float32
+        assert m._y.dtype == np.float32
+
+    # paths are chaotic on the radius boundary, so each step is compared
+    X = line[:, 2:]
+    for t in fate_map.time_iter():
+        assert np.allclose(
+            fate_map._predict(t, X.astype(np.float32)),
+            expected._predict(t, X),
+            atol=1e-3,
+            equal_nan=True,
+        )
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_paths_blocks(
+    line: np.ndarray, reverse: bool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # samples leave the line support along the way
+    fate_map = FateMapping(
+        data=line,
+        radius=5,
+        n_samples=50,
+        sigma=2,
+        reverse=reverse,
+        bind_to_existing=False,
+    )
+    source = line[line[:, 1] == (25 if reverse else 0)][0, 1:]
+    expected = fate_map(source)
+    assert len(expected) < 50 * 26
+
+    for size in (1, 3, 100):
+        monkeypatch.setattr(fate_mapping, "PATHS_BLOCK_SIZE", size)
+        assert np.array_equal(fate_map(source), expected)
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_transport(line: np.ndarray, reverse: bool) -> None:
+    fate_map = FateMapping(
+        data=line, radius=5, reverse=reverse, heatmap=True, transport=True
+    )
+    source = line[-1, 1:] if reverse else line[0, 1:]
+    heatmap = np.asarray(fate_map(source))
+
+    # unit mass is kept while inside the data support
+    mass = heatmap.reshape((len(heatmap), -1)).sum(axis=1)
+    assert np.allclose(mass, 1, atol=1e-5)
+
+    # mass follows the line
+    for t in range(len(heatmap)):
+        coords = np.asarray(np.nonzero(heatmap[t])).T
+        center = np.average(coords, axis=0, weights=heatmap[t][heatmap[t] > 0])
+        expected = line[line[:, 1] == t, 2:].mean(axis=0)
+        assert np.abs(center - expected).max() < 5
+
+    # deterministic
+    assert np.array_equal(np.asarray(fate_map(source)), heatmap)
+
+    fate_map.heatmap = False
+    with pytest.raises(ValueError):
+        fate_map(source)
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_jump_models(line: np.ndarray, reverse: bool) -> None:
+    fate_map = FateMapping(data=line, radius=5, reverse=reverse)
+    fate_map._fit()
+
+    time_iter = fate_map.time_iter(t0=32 if reverse else 17, max_length=13)
+    jumps = fate_map._jump_iter(time_iter)
+    assert [level for _, level in jumps] == [3, 2, 0]
+
+    # without noise jumps are the stepwise advection on the voxel grid
+    rng = np.random.default_rng(0)
+    X = np.round(line[line[:, 1] == time_iter.start, 2:]).astype(int)
+    expected = X.copy()
+    for t in time_iter:
+        expected[:], _ = fate_map._jump(t, 0, expected, rng)
+
+    result = X.copy()
+    for t, level in jumps:
+        result[:], alive = fate_map._jump(t, level, result, rng)
+
+    assert np.array_equal(result, expected)
+    assert np.all(alive)
+
+    # samples leaving the data support keep their last position
+    X = np.full((1, 3), 1000)
+    ends, alive = fate_map._jump(time_iter.start, 3, X, rng)
+    assert np.array_equal(ends, X) and not np.any(alive)
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_grid_spacing(line: np.ndarray, reverse: bool) -> None:
+    expected = FateMapping(
+        data=line, radius=5, reverse=reverse, weights="uniform"
+    )
+    fate_map = FateMapping(
+        data=line,
+        radius=5,
+        reverse=reverse,
+        weights="uniform",
+        grid_spacing=1,
+    )
+
+    rng = np.random.default_rng(42)
+    for t in (10, 25, 40):
+        X = line[line[:, 1] == t, 2:] + rng.normal(size=(5, 3))
+        result = fate_map._predict(t, X)
+        assert np.nanmean(np.abs(result - expected._predict(t, X))) < 0.1
+
+    # fields are kept in a least recently used cache
+    assert list(fate_map._field_frames) == [10, 25, 40]
+    frame = fate_map._field_frames[25]
+    assert fate_map._displacement_field(25) is frame
+    assert list(fate_map._field_frames) == [10, 40, 25]
+
+    # grid points outside the data support are undefined
+    assert np.all(np.isnan(fate_map._predict(10, np.full((1, 3), -100.0))))
+
+    fate_map.grid_spacing = 2
+    assert len(fate_map._field_frames) == 0
+
+
+def test_sparse_field(line: np.ndarray, tmp_path: Path) -> None:
+    expected = FateMapping(data=line, radius=5)
+    fate_map = FateMapping(
+        data=line, radius=5, grid_spacing=4, cache_dir=tmp_path
+    )
+
+    # only grid points near the detections are sampled
+    keys, values = fate_map._displacement_field(10)
+    n_detections = np.sum(line[:, 1] == 10)
+    assert len(keys) <= n_detections * (2 * 5 / 4 + 1) ** 3
+    assert len(list(tmp_path.glob("*/field-*/10.npz"))) == 1
+
+    # samples next to undefined grid points fall back to the model
+    rng = np.random.default_rng(42)
+    X = line[line[:, 1] == 10, 2:] + rng.normal(size=(5, 3))
+    result = fate_map._predict(10, X)
+    assert not np.any(np.isnan(result))
+    assert np.nanmean(np.abs(result - expected._predict(10, X))) < 0.5
+
+    # fields are loaded from the cache directory
+    fate_map = FateMapping(
+        data=line, radius=5, grid_spacing=4, cache_dir=tmp_path
+    )
+    assert np.array_equal(fate_map._displacement_field(10)[0], keys)
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_compute_heatmap(weighted: bool) -> None:
+    rng = np.random.default_rng(42)
+    paths = np.concatenate(
+        (
+            np.ones((1000, 1)),
+            rng.integers(0, 5, size=(1000, 1)),
+            rng.uniform(0, 70, size=(1000, 3)),
+        ),
+        axis=1,
+    )
+    weights = rng.uniform(size=len(paths)) if weighted else None
+
+    fate_map = FateMapping()
+    heatmap = fate_map._compute_heatmap(paths, weights)
+
+    expected = np.zeros(heatmap.shape, dtype=heatmap.dtype)
+    np.add.at(
+        expected,
+        tuple(np.round(paths[:, 1:]).astype(int).T),
+        1 if weights is None else weights,
+    )
+    assert np.allclose(heatmap[:], expected)
+
+
+def test_heatmap_store(line: np.ndarray, tmp_path: Path) -> None:
+    expected = FateMapping(data=line, radius=5, n_samples=5, heatmap=True)
+    fate_map = FateMapping(
+        data=line,
+        radius=5,
+        n_samples=5,
+        heatmap=True,
+        heatmap_store=tmp_path / "heatmap.zarr",
+        heatmap_chunks=(5, 32, 32, 32),
+    )
+    heatmap = fate_map(line[0, 1:])
+
+    assert heatmap.chunks == (5, 32, 32, 32)
+    assert (tmp_path / "heatmap.zarr" / ".zarray").exists()
+
+    stored = zarr.open_array(str(tmp_path / "heatmap.zarr"), mode="r")
+    assert np.array_equal(stored[:], expected(line[0, 1:])[:])
+
+
+def test_crop_heatmap(line: np.ndarray) -> None:
+    expected = FateMapping(data=line, radius=5, n_samples=5, heatmap=True)
+    fate_map = FateMapping(
+        data=line, radius=5, n_samples=5, heatmap=True, crop_heatmap=True
+    )
+    source = line[line[:, 1] == 10][0, 1:]
+    heatmap = fate_map(source)
+    expected = expected(source)
+
+    translate = heatmap.attrs["translate"]
+    assert translate[0] == 10
+    assert np.all(np.asarray(heatmap.shape) < expected.shape)
+    assert expected.attrs["translate"] == [0, 0, 0, 0]
+
+    crop = tuple(slice(o, o + s) for o, s in zip(translate, heatmap.shape))
+    assert np.array_equal(heatmap[:], expected[crop])
+    assert heatmap[:].sum() == expected[:].sum()
+
+
 def test_binding_attr(line: np.ndarray) -> None:
     fate_map = FateMapping(data=line, bind_to_existing=True, n_samples=5)
     result = fate_map(line[0, 1:])
@@ -76,3 +368,83 @@ def test_binding_attr(line: np.ndarray) -> None:
     results_start = np.sort(result[result[:, 1] == 0], axis=0)
 
     assert np.allclose(lines_start, results_start)
+
+
+def test_models_fitted_on_demand(line: np.ndarray) -> None:
+    fate_map = FateMapping(data=line, radius=5, n_samples=5)
+
+    fate_map(line[10, 1:])  # starting at time point 10
+
+    assert min(fate_map._models.keys()) == 10
+    assert len(fate_map._models) == len(list(fate_map.time_iter(t0=10)))
+
+    # samples leaving the data support on the first step
+    fate_map = FateMapping(
+        data=line, radius=5, n_samples=5, bind_to_existing=False, n_workers=2
+    )
+    fate_map(np.array([10, 1000, 1000, 1000]))
+    assert sorted(fate_map._models.keys()) == [10, 11]
+
+
+def test_parallel_fit(line: np.ndarray) -> None:
+    fate_map = FateMapping(data=line, n_workers=4)
+    fate_map._fit()
+
+    assert len(fate_map._models) == fate_map._tmax - fate_map._tmin + 1
+    for m in fate_map._models.values():
+        assert m.n_jobs == 4
+
+    fate_map.n_workers = 2
+    for m in fate_map._models.values():
+        assert m.n_jobs == 2
+
+
+def test_models_cache(
+    line: np.ndarray, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    fate_map = FateMapping(
+        data=line, radius=5, n_samples=5, cache_dir=tmp_path
+    )
+    expected = fate_map(line[0, 1:])
+    assert len(list(tmp_path.glob("*/*.npz"))) == len(fate_map._models)
+
+    def _fail(*args, **kwargs) -> None:
+        raise AssertionError("Models should have been loaded from cache")
+
+    monkeypatch.setattr(FateMapping, "_fit_pairs", _fail)
+    fate_map = FateMapping(
+        data=line, radius=5, n_samples=5, cache_dir=tmp_path
+    )
+    assert np.allclose(fate_map(line[0, 1:]), expected)
+
+    # instances of the same process writing the same frames concurrently do not collide
+    monkeypatch.undo()
+    shared = tmp_path / "shared"
+    instances = [
+        FateMapping(data=line, radius=5, cache_dir=shared) for _ in range(2)
+    ]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                lambda args: args[0]._fit_model(args[1]),
+                itertools.product(instances, range(0, 40)),
+            )
+        )
+    assert len(list(shared.glob("*/*.npz"))) == 40
+    assert len(list(shared.glob("*/*.tmp"))) == 0
+
+
+def test_frame_index_cache(line: np.ndarray) -> None:
+    fate_map = FateMapping(data=line, radius=5, n_samples=5)
+    fate_map._reset_models()
+
+    index = fate_map._frame_index(10)
+    assert fate_map._frame_index(10) is index
+
+    # fitted models indices are shared
+    model = fate_map._models[10]
+    assert fate_map._frame_index(10) is model._index
+
+    for t in range(50):
+        fate_map._frame_index(t)
+    assert len(fate_map._frame_indices) <= INDEX_CACHE_SIZE
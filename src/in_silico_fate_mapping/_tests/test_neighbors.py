@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from in_silico_fate_mapping.neighbors import (
+    BACKENDS,
+    NeighborsIndex,
+    build_index,
+)
+
+
+@pytest.mark.parametrize("backend", list(BACKENDS.keys()))
+@pytest.mark.parametrize("dim", [2, 3])
+def test_backends_equivalence(backend: str, dim: int) -> None:
+    rng = np.random.default_rng(42)
+    data = rng.uniform(0, 100, size=(1000, dim))
+    queries = rng.uniform(0, 100, size=(500, dim))
+
+    expected = build_index(data, "brute")
+    index = build_index(data, backend)
+
+    def _sorted_pairs(index):
+        src, dst, dist = index.radius_pairs(queries, 10)
+        order = np.lexsort((dst, src))
+        return src[order], dst[order], dist[order]
+
+    for result, other in zip(_sorted_pairs(index), _sorted_pairs(expected)):
+        assert np.allclose(result, other)
+
+    assert np.array_equal(index.query(queries, 5), expected.query(queries, 5))
+
+
+@pytest.mark.parametrize("n_jobs", [3, -1])
+def test_threaded_radius_pairs(n_jobs: int) -> None:
+    rng = np.random.default_rng(42)
+    data = rng.uniform(0, 100, size=(1000, 3))
+    queries = rng.uniform(0, 100, size=(5000, 3))
+
+    index = build_index(data, "ckdtree")
+    expected = index.radius_pairs(queries, 10)
+    result = index.radius_pairs(queries, 10, n_jobs=n_jobs)
+
+    # blocks of queries are searched by each thread
+    order = np.lexsort(expected[1::-1])
+    other = np.lexsort(result[1::-1])
+    for a, b in zip(result, expected):
+        assert np.array_equal(a[other], b[order])
+
+
+def test_invalid_backend() -> None:
+    with pytest.raises(ValueError):
+        build_index(np.zeros((5, 3)), "octree")
+
+
+def test_abstract_index() -> None:
+    class _RadiusOnlyIndex(NeighborsIndex):
+        def radius_pairs(self, X, radius, n_jobs=None):
+            return np.empty(0), np.empty(0), np.empty(0)
+
+    # every search must be implemented
+    with pytest.raises(TypeError):
+        _RadiusOnlyIndex(np.zeros((5, 3)))
+
+
+def test_grid_radius_change() -> None:
+    rng = np.random.default_rng(42)
+    data = rng.uniform(0, 100, size=(1000, 3))
+    queries = rng.uniform(0, 100, size=(500, 3))
+
+    grid = build_index(data, "grid")
+    expected = build_index(data, "ckdtree")
+
+    # cells are rebuilt with the size of each new radius
+    for radius in (5, 12, 3):
+        src, _, _ = grid.radius_pairs(queries, radius)
+        expected_src, _, _ = expected.radius_pairs(queries, radius)
+        assert grid._cell_size == radius
+        assert np.array_equal(np.sort(src), np.sort(expected_src))
+
+
+@pytest.mark.parametrize("backend", list(BACKENDS.keys()))
+def test_empty_index(backend: str) -> None:
+    index = build_index(np.empty((0, 3)), backend)
+    for result in index.radius_pairs(np.ones((5, 3)), 10):
+        assert len(result) == 0
+
+
+@pytest.mark.parametrize("backend", list(BACKENDS.keys()))
+def test_query_more_than_data(backend: str) -> None:
+    rng = np.random.default_rng(42)
+    index = build_index(rng.uniform(0, 10, size=(5, 3)), backend)
+    assert index.query(np.ones((2, 3)), 5).shape == (2, 5)
+    with pytest.raises(ValueError, match="k must be less than or equal"):
+        index.query(np.ones((2, 3)), 25)
+
+
+def test_grid_overflow() -> None:
+    rng = np.random.default_rng(42)
+    data = rng.uniform(0, 100, size=(1000, 3))
+    data[0] = 1e7
+    queries = rng.uniform(0, 100, size=(500, 3))
+    queries[0] = 1e150
+
+    # 1e7 cells of size 0.5 along each axis overflow int64 keys
+    grid = build_index(data, "grid")
+    src, dst, _ = grid.radius_pairs(queries, 0.5)
+    assert grid._shape is None
+
+    expected_src, expected_dst, _ = build_index(data, "brute").radius_pairs(
+        queries, 0.5
+    )
+    assert np.array_equal(np.sort(src), np.sort(expected_src))
+    assert np.array_equal(np.sort(dst), np.sort(expected_dst))
+
+    # far queries are clipped out of the grid
+    grid = build_index(data[1:], "grid")
+    src, _, _ = grid.radius_pairs(queries, 10)
+    assert grid._shape is not None
+    expected_src, _, _ = build_index(data[1:], "brute").radius_pairs(
+        queries, 10
+    )
+    assert np.array_equal(np.sort(src), np.sort(expected_src))
@@ -85,6 +85,7 @@ class FateMappingWidget(Container):
             heatmap=self._heatmap_w.value,
             n_samples=self._n_samples_w.value,
             bind_to_existing=self._bind_w.value,
+            crop_heatmap=True,
         )
 
         self._setup_signals()
@@ -134,6 +135,11 @@ class FateMappingWidget(Container):
         data = layer.data.copy()
         # converting to anisotropic space
         data[:, 1:] = layer._data_to_world(data[:, 1:])
+        # keeping fitted models and indices when tracks did not change
+        if self._fate_mapping._data_hash == self._fate_mapping._hash_data(
+            data
+        ):
+            return
         self._fate_mapping.data = data
 
     def _on_run(self) -> None:
@@ -158,6 +164,7 @@ class FateMappingWidget(Container):
                 colormap="magma",
                 blending="additive",
                 name="Fate Map Heatmap",
+                translate=result.attrs["translate"],
             )
         else:
             self._viewer.add_tracks(
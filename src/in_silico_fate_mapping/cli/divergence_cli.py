@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 import click
 import napari
@@ -12,7 +12,7 @@ from scipy.ndimage import (
 )
 from tifffile import imwrite
 
-from in_silico_fate_mapping.divergence import Divergence
+from in_silico_fate_mapping.divergence import SPREAD_STATISTICS, Divergence
 
 
 def disk(rank: int, radius: int) -> np.ndarray:
@@ -70,6 +70,68 @@ def disk(rank: int, radius: int) -> np.ndarray:
     show_default=True,
     help="Length (in time) to stop divergence computation.",
 )
+@click.option(
+    "--n-workers",
+    "-w",
+    type=int,
+    default=8,
+    show_default=True,
+    help="Number of threads fitting the interpolation models and searching their neighbors.",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Directory to cache fitted models between runs.",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["auto", "ckdtree", "kd_tree", "brute", "grid"]),
+    default="auto",
+    show_default=True,
+    help="Neighbors search backend.",
+)
+@click.option(
+    "--jumps",
+    type=bool,
+    default=False,
+    is_flag=True,
+    help="Advects with precomposed multi-frame jumps reused between tiles, noisier where samples converge.",
+)
+@click.option(
+    "--tile-size",
+    type=int,
+    default=None,
+    help="Processes the mask in cubic tiles of this size to bound memory.",
+)
+@click.option(
+    "--n-processes",
+    "-p",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes computing mask tiles in parallel.",
+)
+@click.option(
+    "--samples-per-pass",
+    type=int,
+    default=None,
+    help="Number of samples per pixel advected at once to bound memory.",
+)
+@click.option(
+    "--statistic",
+    type=click.Choice(list(SPREAD_STATISTICS)),
+    default="std",
+    show_default=True,
+    help="Spread statistic of each pixel samples.",
+)
+@click.option(
+    "--horizon",
+    "horizons",
+    type=int,
+    multiple=True,
+    help="Lengths (in time) of stacked divergence outputs computed in a single pass, overrides --max-length.",
+)
 def div(
     tracks_path: Path,
     time_point: int,
@@ -81,6 +143,15 @@ def div(
     quiet: bool,
     downsample: Optional[float],
     max_length: Optional[int],
+    n_workers: int,
+    cache_dir: Optional[Path],
+    backend: str,
+    jumps: bool,
+    tile_size: Optional[int],
+    n_processes: int,
+    samples_per_pass: Optional[int],
+    statistic: str,
+    horizons: Tuple[int, ...],
 ) -> None:
     """Computes the divergence of tracks from a given time point"""
 
@@ -92,7 +163,18 @@ def div(
     tracks = pd.read_csv(tracks_path)
     tracks["z"] *= z_scale
 
-    divergence = Divergence(tracks, n_samples=n_samples, radius=radius)
+    divergence = Divergence(
+        tracks,
+        n_samples=n_samples,
+        radius=radius,
+        n_workers=n_workers,
+        cache_dir=cache_dir,
+        backend=backend,
+        jumps=jumps,
+        n_processes=n_processes,
+        samples_per_pass=samples_per_pass,
+        statistic=statistic,
+    )
 
     source = tracks[np.abs(tracks["t"] - time_point) < 1][
         divergence._spatial_columns
@@ -110,18 +192,27 @@ def div(
         struct = disk(mask.ndim, dilation)
         mask = binary_dilation(mask, struct)
 
-    heatmap = divergence(mask, time_point, max_length)
+    if tile_size is not None:
+        divergence.tile_shape = (tile_size,) * mask.ndim
+
+    if horizons:
+        heatmap = divergence.multi_horizon(mask, time_point, horizons)
+        # horizons axis is kept
+        zoom_factors = (1,) + (downsample,) * mask.ndim
+    else:
+        heatmap = divergence(mask, time_point, max_length)
+        zoom_factors = downsample
 
     if downsample is not None:
         try:
             import cupy as cp
             from cupyx.scipy.ndimage import zoom
 
-            heatmap = zoom(cp.asarray(heatmap), downsample).get()
+            heatmap = zoom(cp.asarray(heatmap), zoom_factors).get()
         except ImportError:
             from scipy.ndimage import zoom
 
-            heatmap = zoom(heatmap, downsample)
+            heatmap = zoom(heatmap, zoom_factors)
 
     imwrite(output_path, heatmap)
 
@@ -1,10 +1,132 @@
-from typing import Optional, Union
+import copy
+import itertools
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import pandas as pd
+import zarr
 from tqdm import tqdm
 
-from in_silico_fate_mapping.fate_mapping import FateMapping, update_fit
+from in_silico_fate_mapping.fate_mapping import (
+    FateMapping,
+    _grid_keys,
+    _ModelStore,
+    update_fit,
+)
+
+# spread statistics computed from each source samples
+SPREAD_STATISTICS = ("std", "rms", "displacement")
+
+# divergence instance of the current worker process
+_worker: Optional["Divergence"] = None
+
+
+def _init_worker(
+    divergence: "Divergence",
+    directory: str,
+    jump_slices: Dict[Tuple, Tuple[int, int]],
+) -> None:
+    """Sets up the worker process divergence, its models are fitted from memory-mapped pairs
+    and its jump tables are read-only slices of the memory-mapped parent tables
+    """
+    global _worker
+    directory = Path(directory)
+    divergence._coords = np.load(directory / "coords.npy", mmap_mode="r")
+    divergence._targets = np.load(directory / "targets.npy", mmap_mode="r")
+
+    if len(jump_slices) > 0:
+        keys, ends, alive = (
+            np.load(directory / f"jump_{name}.npy", mmap_mode="r")
+            for name in ("keys", "ends", "alive")
+        )
+        for (time, level, *_), (start, stop) in jump_slices.items():
+            table = divergence._jump_table(time, level)
+            table.keys = keys[start:stop]
+            table.ends = ends[start:stop]
+            table.alive = alive[start:stop]
+
+    _worker = divergence
+
+
+def _worker_tile_divergence(*args) -> np.ndarray:
+    """Computes a tile divergence on the worker process"""
+    return _worker._tile_divergence(*args)
+
+
+class _OnlineMoments:
+    def __init__(self, shape: Tuple[int, int]) -> None:
+        """Per row mean and sum of squared deviations updated by batches of samples (Welford's algorithm).
+
+        Parameters
+        ----------
+        shape : Tuple[int, int]
+            Number of rows and of dimensions.
+        """
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, samples: np.ndarray) -> None:
+        """Merges a (N, B, D) batch of B samples per row"""
+        count = samples.shape[1]
+        mean = samples.mean(axis=1)
+        m2 = np.square(samples - mean[:, np.newaxis]).sum(axis=1)
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (count / total)
+        self.m2 += m2 + np.square(delta) * (self.count * count / total)
+        self.count = total
+
+    @property
+    def var(self) -> np.ndarray:
+        """(N, D) population variance"""
+        return self.m2 / self.count
+
+    def statistic(self, name: str, origin: np.ndarray) -> np.ndarray:
+        """Computes a spread statistic of each row.
+
+        Parameters
+        ----------
+        name : str
+            "std" for the sum of standard deviations along each axis,
+            "rms" for the root mean squared distance to the samples mean,
+            "displacement" for the distance from `origin` to the samples mean.
+        origin : np.ndarray
+            (N, D) samples starting coordinates.
+
+        Returns
+        -------
+        np.ndarray
+            (N,) statistic.
+        """
+        if name == "std":
+            return np.sqrt(self.var).sum(axis=1)
+        elif name == "rms":
+            return np.sqrt(self.var.sum(axis=1))
+        elif name == "displacement":
+            return np.linalg.norm(self.mean - origin, axis=1)
+        raise ValueError(
+            f"statistic must be one of {SPREAD_STATISTICS}. Found {name}"
+        )
 
 
 class Divergence(FateMapping):
@@ -16,6 +138,16 @@ class Divergence(FateMapping):
         sigma: float = 0.1,
         weights: str = "distance",
         n_samples: int = 25,
+        n_workers: int = 8,
+        cache_dir: Optional[Union[str, Path]] = None,
+        max_memory: int = 2**30,
+        backend: str = "auto",
+        dtype: Union[str, np.dtype, type] = np.float64,
+        jumps: bool = False,
+        tile_shape: Optional[Tuple[int, ...]] = None,
+        n_processes: int = 1,
+        samples_per_pass: Optional[int] = None,
+        statistic: str = "std",
     ) -> None:
         """
         Computes divergence of a given mask using the fate map simulation.
@@ -34,6 +166,36 @@ class Divergence(FateMapping):
             Interpolation weighting strategy, by default "distance"
         n_samples : int, optional
             Number of samples per individual coordinate, by default 25
+        n_workers : int, optional
+            Number of threads fitting models in parallel, also used by neighbors searches of
+            the "ckdtree" backend, by default 8
+        cache_dir : Optional[Union[str, Path]], optional
+            Directory to store fitted models and reuse them between runs, by default None
+        max_memory : int, optional
+            Approximated memory budget in bytes of each chunk of interpolated samples, by default 1GB
+        backend : str, optional
+            Neighbors search backend, one of "auto", "ckdtree", "kd_tree", "brute" or "grid", by default "auto"
+        dtype : Union[str, np.dtype, type], optional
+            Floating point type of tracks, models and paths, by default np.float64
+        jumps : bool, optional
+            Advects samples on the voxel grid with precomposed jumps of power of two lengths,
+            taking log(T) steps. Each jump keeps `JUMP_SAMPLES` stepwise realizations per visited
+            voxel, reused by later tiles and calls. Its spread matches the stepwise one in
+            distribution but is noisier where samples converge to few voxels, by default False
+        tile_shape : Optional[Tuple[int, ...]], optional
+            Mask tiles shape, each tile samples are advected separately to bound memory,
+            by default None (whole mask at once)
+        n_processes : int, optional
+            Number of worker processes computing mask tiles in parallel, each one fits
+            its own models from the shared fitted pairs while jump tables are composed
+            once and shared read-only, by default 1
+        samples_per_pass : Optional[int], optional
+            Number of samples per coordinate advected at once, their statistics are reduced
+            online between passes, by default None (all `n_samples` at once)
+        statistic : str, optional
+            Spread statistic, "std" (sum of standard deviations along each axis), "rms"
+            (root mean squared distance to the samples mean) or "displacement" (distance
+            from the source to the samples mean), by default "std"
         """
         super().__init__(
             data=data,
@@ -44,62 +206,384 @@ class Divergence(FateMapping):
             heatmap=False,
             n_samples=n_samples,
             bind_to_existing=False,
+            n_workers=n_workers,
+            cache_dir=cache_dir,
+            max_memory=max_memory,
+            backend=backend,
+            dtype=dtype,
+        )
+        self.jumps = jumps
+        self.tile_shape = tile_shape
+        self.n_processes = n_processes
+        self.samples_per_pass = samples_per_pass
+        self.statistic = statistic
+        self._show_progress = True
+
+    def _tiles(self, shape: Tuple[int, ...]) -> Iterable[Tuple[slice, ...]]:
+        """Iterates over the tiles slices of an array of the given shape"""
+        tile_shape = shape if self.tile_shape is None else self.tile_shape
+        if len(tile_shape) != len(shape):
+            raise ValueError(
+                f"tile_shape must have length {len(shape)}. Found {tile_shape}"
+            )
+
+        starts = (range(0, s, t) for s, t in zip(shape, tile_shape))
+        for corner in itertools.product(*starts):
+            yield tuple(
+                slice(c, min(c + t, s))
+                for c, t, s in zip(corner, tile_shape, shape)
+            )
+
+    def _segments(
+        self, time_point: int, max_lengths: Sequence[Optional[int]]
+    ) -> Tuple[range, List[List[Tuple[int, int]]]]:
+        """Splits the advection (time, level) steps into segments ending at each horizon.
+
+        Returns the longest time iterable and the segments.
+        """
+        t0 = int(round(time_point))
+        time_iters = [self.time_iter(t0=t0, max_length=m) for m in max_lengths]
+        lengths = [len(time_iter) for time_iter in time_iters]
+        if len(lengths) == 0 or np.any(np.diff(lengths) < 0):
+            raise ValueError(
+                f"Horizons must be a non-empty increasing sequence. Found {max_lengths}"
+            )
+
+        segments = []
+        start = t0
+        for time_iter in time_iters:
+            segment = range(start, time_iter.stop, self.step)
+            if self.jumps:
+                segments.append(self._jump_iter(segment))
+            else:
+                segments.append([(t, 0) for t in segment])
+            start = time_iter.stop
+
+        return time_iters[-1], segments
+
+    def _advect(
+        self,
+        pos: np.ndarray,
+        segments: List[List[Tuple[int, int]]],
+        rng: np.random.Generator,
+    ) -> Iterator[np.ndarray]:
+        """Advects samples in place yielding them at the end of each segment,
+        samples leaving the data support keep their last position
+        """
+        # indices of samples inside the data support
+        active = np.nonzero(self._valid_rows(pos))[0]
+        times = [t for steps in segments for t, _ in steps]
+        i = 0
+
+        for steps in segments:
+            for t, level in tqdm(
+                steps, "Computing paths", disable=not self._show_progress
+            ):
+                if len(active) == 0:
+                    break
+                if self.jumps:
+                    # jump tables are composed before advecting
+                    pos[active], alive = self._draw_jump(
+                        t, level, pos[active], rng
+                    )
+                else:
+                    self._fit_ahead(times[i:])
+                    i += 1
+                    pos[active], alive = self._jump(t, level, pos[active], rng)
+                active = active[alive]
+            yield pos
+
+    def _compose_jumps(
+        self, coords: np.ndarray, segments: List[List[Tuple[int, int]]]
+    ) -> None:
+        """Composes the jump realizations of every voxel reachable from `coords` through `segments`"""
+        voxels = np.asarray(coords, dtype=np.int64)
+        for t, level in itertools.chain.from_iterable(segments):
+            if len(voxels) == 0:
+                break
+            ends, alive = self._jump_realizations(t, level, voxels)
+            ends = ends[alive]
+            _, first = np.unique(_grid_keys(ends), return_index=True)
+            voxels = ends[first].astype(np.int64)
+
+    def _spread(
+        self,
+        coords: np.ndarray,
+        time_point: int,
+        segments: List[List[Tuple[int, int]]],
+        tile_index: int = 0,
+    ) -> np.ndarray:
+        """Advects `n_samples` from each coordinate in passes, returns their (H, N) spread statistic at each horizon.
+
+        Noise is seeded by `tile_index`, each tile draws an independent stream whichever process computes it.
+        """
+        source = np.concatenate(
+            (np.full((len(coords), 1), time_point), coords), axis=1
+        )
+        # samples stay on the mask voxel grid
+        coords = self._validate_source(source)[:, 1:]
+        n_coords, n_dim = coords.shape
+
+        per_pass = self.n_samples
+        if self.samples_per_pass is not None:
+            per_pass = min(per_pass, self.samples_per_pass)
+
+        rng = np.random.default_rng(
+            np.random.SeedSequence(42, spawn_key=(tile_index,))
         )
+        moments = [_OnlineMoments((n_coords, n_dim)) for _ in segments]
+
+        for start in range(0, self.n_samples, per_pass):
+            n_samples = min(per_pass, self.n_samples - start)
+            snapshots = self._advect(
+                np.repeat(coords, n_samples, axis=0), segments, rng
+            )
+            for horizon_moments, pos in zip(moments, snapshots):
+                horizon_moments.update(
+                    pos.reshape((n_coords, n_samples, n_dim))
+                )
+
+        return np.stack([m.statistic(self.statistic, coords) for m in moments])
+
+    def _tile_divergence(
+        self,
+        block: np.ndarray,
+        offset: List[int],
+        time_point: int,
+        segments: List[List[Tuple[int, int]]],
+        tile_index: int,
+    ) -> np.ndarray:
+        """(H, tile shape) divergence of the `tile_index` binary mask tile starting at `offset`"""
+        divergence = np.zeros((len(segments),) + block.shape, dtype=np.float32)
+        if np.any(block):
+            coords = np.asarray(np.nonzero(block)).T + offset
+            divergence[:, block] = self._spread(
+                coords, time_point, segments, tile_index
+            )
+        return divergence
+
+    @staticmethod
+    def _write_tile(
+        out: Union[np.ndarray, zarr.Array],
+        tile: Tuple[slice, ...],
+        divergence: np.ndarray,
+    ) -> None:
+        """Writes a (H, tile shape) divergence into the (H, mask shape) or mask shaped output"""
+        if out.ndim == len(tile):
+            out[tile] = divergence[0]
+        else:
+            out[(slice(None),) + tile] = divergence
+
+    def _worker_state(
+        self, directory: Path, times: Iterable[int]
+    ) -> Tuple["Divergence", str, Dict[Tuple, Tuple[int, int]]]:
+        """Writes the coordinates, the fitted targets of `times` and the current direction jump
+        tables to `directory` to be memory-mapped by worker processes, returns a copy without
+        data, models and jump tables, the directory and each jump table rows.
+        """
+        n_dim = len(self._spatial_columns)
+        targets = np.full(
+            (len(self._coords), 2 * n_dim), np.nan, dtype=self.dtype
+        )
+        for t in times:
+            targets[self._frame(t)] = self._models[t]._y
+
+        np.save(directory / "coords.npy", self._coords)
+        np.save(directory / "targets.npy", targets)
+
+        # jump tables are concatenated, each one is a slice of rows
+        tables = {
+            key: table
+            for key, table in self._jumps.items()
+            if key[2:] == (self.step, self.sigma)
+        }
+        jump_slices = {}
+        start = 0
+        for key, table in tables.items():
+            jump_slices[key] = (start, start + len(table.keys))
+            start += len(table.keys)
+        if len(tables) > 0:
+            for name in ("keys", "ends", "alive"):
+                np.save(
+                    directory / f"jump_{name}.npy",
+                    np.concatenate(
+                        [getattr(table, name) for table in tables.values()]
+                    ),
+                )
+
+        worker = copy.copy(self)
+        worker._coords = None
+        worker._track_ids = None
+        worker._next_rows = None
+        worker._prev_rows = None
+        worker.cache_dir = None
+        worker._models = _ModelStore(worker._fit_model)
+        worker._frame_indices = OrderedDict()
+        worker._reset_derived()
+        worker.n_workers = 1
+        worker._show_progress = False
+
+        return worker, str(directory), jump_slices
+
+    def _parallel_divergence(
+        self,
+        mask: Union[np.ndarray, zarr.Array],
+        out: Union[np.ndarray, zarr.Array],
+        time_point: int,
+        time_iter: Iterable[int],
+        segments: List[List[Tuple[int, int]]],
+    ) -> None:
+        """Computes the divergence of mask tiles in worker processes sharing the fitted pairs.
+
+        At most 2 * `n_processes` tiles are in flight, mask tiles are read when submitted
+        and results are written as they complete. Each process memory-maps the fitted pairs
+        and fits its own models, so it adds the memory and CPU time of the models of every
+        time point it advects through. With jumps, processes only read the memory-mapped jump
+        tables composed beforehand and fit no models.
+        """
+        tiles = list(self._tiles(mask.shape))
+        max_pending = 2 * self.n_processes
+
+        with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(
+            max_workers=self.n_processes,
+            initializer=_init_worker,
+            initargs=self._worker_state(Path(tmp_dir), time_iter),
+        ) as executor, tqdm(
+            total=len(tiles), desc="Computing divergence"
+        ) as progress:
+            pending = {}
+            for tile_index, tile in enumerate(tiles):
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        tile_done = pending.pop(future)
+                        self._write_tile(out, tile_done, future.result())
+                    progress.update(len(done))
+
+                future = executor.submit(
+                    _worker_tile_divergence,
+                    np.asarray(mask[tile], dtype=bool),
+                    [s.start for s in tile],
+                    time_point,
+                    segments,
+                    tile_index,
+                )
+                pending[future] = tile
+
+            for future in as_completed(pending):
+                self._write_tile(out, pending[future], future.result())
+                progress.update()
+
+    def _divergence(
+        self,
+        mask: Union[np.ndarray, zarr.Array],
+        time_point: int,
+        max_lengths: Sequence[Optional[int]],
+        out: Union[np.ndarray, zarr.Array],
+    ) -> None:
+        """Computes the divergence of `mask` at each horizon into `out`"""
+        if self.statistic not in SPREAD_STATISTICS:
+            raise ValueError(
+                f"statistic must be one of {SPREAD_STATISTICS}. Found {self.statistic}"
+            )
+
+        time_iter, segments = self._segments(time_point, max_lengths)
+        if self.jumps or self.n_processes > 1:
+            # jump tables and worker processes require every model up to the last horizon
+            self._fit(time_iter)
+
+        if self.jumps:
+            # tables are composed tile by tile in order, so they do not depend on the processes
+            for tile in self._tiles(mask.shape):
+                block = np.asarray(mask[tile], dtype=bool)
+                coords = np.asarray(np.nonzero(block)).T + [
+                    s.start for s in tile
+                ]
+                self._compose_jumps(coords, segments)
+
+        if self.n_processes > 1:
+            self._parallel_divergence(
+                mask, out, time_point, time_iter, segments
+            )
+            return
+
+        for tile_index, tile in enumerate(self._tiles(mask.shape)):
+            divergence = self._tile_divergence(
+                np.asarray(mask[tile], dtype=bool),
+                [s.start for s in tile],
+                time_point,
+                segments,
+                tile_index,
+            )
+            self._write_tile(out, tile, divergence)
 
     @update_fit
     def __call__(
         self,
-        mask: np.ndarray,
+        mask: Union[np.ndarray, zarr.Array],
         time_point: int,
         max_length: Optional[int] = None,
-    ) -> np.ndarray:
+        out: Optional[Union[np.ndarray, zarr.Array]] = None,
+    ) -> Union[np.ndarray, zarr.Array]:
         """Returns divergence measurement of given mask starting from the given time point.
 
         Parameters
         ----------
-        mask : np.ndarray
+        mask : Union[np.ndarray, zarr.Array]
             Binary array.
         time_point : int
             Time point belonging to training data range.
+        max_length : Optional[int], optional
+            Length (in time) to stop divergence computation, by default None
+        out : Optional[Union[np.ndarray, zarr.Array]], optional
+            Output array with the mask shape, written tile by tile, by default a new float32 array
 
         Returns
         -------
-        np.ndarray
+        Union[np.ndarray, zarr.Array]
             Divergence heatmap.
         """
-        coords = np.asarray(np.nonzero(mask)).T
-        source = np.concatenate(
-            (np.full((len(coords), 1), time_point), coords), axis=1
-        )
-
-        source = self._preprocess_source(source)
-        t0 = source[0, 0]
-
-        pos = np.asarray(source[:, 1:])
-        shape = pos.shape
-
-        _noise = self._get_noise_function(shape)
+        if out is None:
+            out = np.zeros(mask.shape, dtype=np.float32)
+        elif out.shape != mask.shape:
+            raise ValueError(
+                f"out shape must match mask shape {mask.shape}. Found {out.shape}"
+            )
 
-        valid = self._valid_rows(pos)
+        self._divergence(mask, time_point, [max_length], out)
+        return out
 
-        for t in tqdm(
-            self.time_iter(t0=int(round(t0)), max_length=max_length),
-            "Computing paths",
-        ):
-            X = (pos + _noise())[valid]
-            if len(X) == 0:
-                break
-            next_pos = self._models[t].predict(X)
-            new_valid = self._valid_rows(next_pos)
-            valid[valid] &= new_valid
-            pos[valid] = next_pos[new_valid]
+    @update_fit
+    def multi_horizon(
+        self,
+        mask: Union[np.ndarray, zarr.Array],
+        time_point: int,
+        horizons: Sequence[Optional[int]],
+        out: Optional[Union[np.ndarray, zarr.Array]] = None,
+    ) -> Union[np.ndarray, zarr.Array]:
+        """Returns divergence measurements of given mask at multiple horizons from a single advection.
 
-        pos = pos.T  # (D, K * N), K = n_samples
-        pos = pos.reshape((shape[1], -1, self.n_samples))  # (D, N, K)
-        stddev = pos.std(axis=-1)  # (D, N)
-        stddev = stddev.sum(axis=0)  # (N,)
+        Parameters
+        ----------
+        mask : Union[np.ndarray, zarr.Array]
+            Binary array.
+        time_point : int
+            Time point belonging to training data range.
+        horizons : Sequence[Optional[int]]
+            Increasing lengths (in time) where divergence is measured, None for the data range end.
+        out : Optional[Union[np.ndarray, zarr.Array]], optional
+            Output array with (H, mask shape) shape, written tile by tile, by default a new float32 array
 
-        divergence = np.zeros(mask.shape, dtype=np.float32)
-        divergence[mask] = stddev
+        Returns
+        -------
+        Union[np.ndarray, zarr.Array]
+            (H, mask shape) divergence heatmaps stacked by horizon.
+        """
+        shape = (len(horizons),) + mask.shape
+        if out is None:
+            out = np.zeros(shape, dtype=np.float32)
+        elif out.shape != shape:
+            raise ValueError(f"out shape must be {shape}. Found {out.shape}")
 
-        return divergence
+        self._divergence(mask, time_point, horizons, out)
+        return out
@@ -1,13 +1,20 @@
 import warnings
-from typing import Sequence
+from typing import Optional, Tuple
 
 import numpy as np
-from scipy import sparse
 from sklearn.neighbors import RadiusNeighborsRegressor
 
+from in_silico_fate_mapping.neighbors import as_float_array, build_index
 
-def _get_flat_weights(dist, weights, flat_size):
-    """Get the weights from an array of distances and a parameter ``weights``.
+# approximated memory of each neighbor pair: indices, distance, weight and scratch buffer
+_PAIR_NBYTES = 48
+
+# maximum queries of the first chunk, used to estimate the number of neighbors per query
+_INITIAL_CHUNK_SIZE = 4096
+
+
+def _get_flat_weights(dist, weights):
+    """Get the weights from a flat array of distances and a parameter ``weights``.
 
     Parameters
     ----------
@@ -20,75 +27,154 @@ def _get_flat_weights(dist, weights, flat_size):
     Returns
     -------
     weights_arr : array of the same shape as ``dist``
-        If ``weights == 'uniform'``, then returns None.
     """
+    # high value number to emulate identity function when dist == 0.0
+    dist_zero_constant = 1e10
 
     if weights in ("uniform", None):
-        weights = np.ones(flat_size, dtype=bool)
+        return np.ones_like(dist)
+    elif weights == "distance":
+        # invert distance and assign binary encoding to point with zero distance to training points
+        with np.errstate(divide="ignore"):
+            return np.where(dist == 0.0, dist_zero_constant, 1.0 / dist)
+    elif callable(weights):
+        return weights(dist)
     else:
-        if weights == "distance":
-            weights = dist
-        elif callable(weights):
-            weights = weights(dist)
-        else:
-            raise ValueError(
-                "weights not recognized: should be 'uniform', "
-                "'distance', or a callable function"
-            )
-        weights = np.concatenate(weights, axis=0)
+        raise ValueError(
+            "weights not recognized: should be 'uniform', "
+            "'distance', or a callable function"
+        )
+
+
+def _weighted_average(
+    neigh_src: np.ndarray,
+    neigh_dst: np.ndarray,
+    weights: np.ndarray,
+    y: np.ndarray,
+    y_pred: np.ndarray,
+    norm_factor: np.ndarray,
+    scratch: np.ndarray,
+) -> None:
+    """Accumulates the weighted average of `y` neighbors directly into the output buffers.
+
+    Parameters
+    ----------
+    neigh_src : np.ndarray
+        Flat array of query indices of each neighbor pair.
+    neigh_dst : np.ndarray
+        Flat array of training indices of each neighbor pair.
+    weights : np.ndarray
+        Flat array of weights of each neighbor pair.
+    y : np.ndarray
+        (n_samples, n_outputs) training targets.
+    y_pred : np.ndarray
+        (n_queries, n_outputs) output weighted average.
+    norm_factor : np.ndarray
+        (n_queries,) output normalization factor.
+    scratch : np.ndarray
+        Buffer with the same length as the neighbor pairs.
+    """
+    n_queries = len(norm_factor)
+    norm_factor[:] = np.bincount(neigh_src, weights, minlength=n_queries)
 
-    return weights
+    for i in range(y.shape[1]):
+        np.take(y[:, i], neigh_dst, out=scratch)
+        np.multiply(scratch, weights, out=scratch)
+        y_pred[:, i] = np.bincount(neigh_src, scratch, minlength=n_queries)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y_pred /= norm_factor[:, np.newaxis]
+    y_pred[norm_factor == 0] = np.nan
 
 
 class FastRadiusRegressor(RadiusNeighborsRegressor):
-    def _get_sparse_weights(
+    def __init__(
         self,
-        training_size: int,
-        neigh_dist: Sequence[np.ndarray],
-        neigh_ind: Sequence[np.ndarray],
-    ) -> sparse.csr_matrix:
-        """
+        radius: float = 1.0,
+        *,
+        weights: str = "uniform",
+        algorithm: str = "auto",
+        leaf_size: int = 5,
+        n_jobs: Optional[int] = None,
+        max_memory: int = 2**30,
+    ) -> None:
+        """Radius neighbors regression with memory bounded predictions.
+
         Parameters
         ----------
-        training_size : int
-            Number of training samples.
-        neigh_dist : Sequence[np.ndarray]
-            List of neighbors distances.
-        neigh_ind : Sequence[np.ndarray]
-            List of neighbors indices.
-        Returns
-        -------
-        sparse.csr_matrix
-            Output weight matrix.
+        radius : float, optional
+            Neighborhood radius, by default 1.0
+        weights : str, optional
+            Interpolation weighting strategy, by default "uniform"
+        algorithm : str, optional
+            Neighbors search backend, one of "auto", "ckdtree", "kd_tree", "brute" or "grid", by default "auto"
+        leaf_size : int, optional
+            Neighbors index leaf size, by default 5
+        n_jobs : Optional[int], optional
+            Number of threads of radius searches supporting them, by default None
+        max_memory : int, optional
+            Approximated memory budget in bytes of each prediction chunk, by default 1GB
         """
-        dist_zero_constant = 1e10  # high value number to emulate identity function when dist == 0.0
+        super().__init__(
+            radius=radius,
+            weights=weights,
+            algorithm=algorithm,
+            leaf_size=leaf_size,
+            n_jobs=n_jobs,
+        )
+        self.max_memory = max_memory
 
-        size = len(neigh_ind)
-        lengths = np.asarray([len(ind) for ind in neigh_ind])
+    def fit(self, X, y):
+        """Fit the radius neighbors regressor from the training dataset.
 
-        neigh_dst = np.concatenate(neigh_ind, axis=0)
-        neigh_src = np.repeat(np.arange(size), repeats=lengths)
+        Differently from sklearn, `y` may contain NaN values to represent
+        undefined targets, which are propagated to the predictions, and
+        the neighbors index is built by the `algorithm` backend.
 
-        weights = _get_flat_weights(neigh_dist, self.weights, len(neigh_src))
-        weights = sparse.csr_matrix(
-            (weights, (neigh_src, neigh_dst)), shape=(size, training_size)
+        Parameters
+        ----------
+        X : array-like of shape (n_samples, n_features)
+            Training data.
+        y : array-like of shape (n_samples,) or (n_samples, n_outputs)
+            Target values.
+
+        Returns
+        -------
+        self : FastRadiusRegressor
+            The fitted radius neighbors regressor.
+        """
+        self._fit_X = as_float_array(X)
+        self._y = np.asarray(y)
+        self.n_features_in_ = self._fit_X.shape[1]
+        self.n_samples_fit_ = self._fit_X.shape[0]
+        self._index = build_index(
+            self._fit_X, self.algorithm, leaf_size=self.leaf_size
         )
+        return self
 
-        # invert distance and assign binary encoding to point with zero distance to training points
-        if self.weights == "distance":
-            weights.data = np.where(
-                weights.data == 0.0, dist_zero_constant, 1.0 / weights.data
-            )
+    def _radius_pairs(
+        self, X: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Finds every (query, training) pair within radius as flat arrays.
 
-        return weights
+        Parameters
+        ----------
+        X : np.ndarray
+            (n_queries, n_features) query samples.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray]
+            Query indices, training indices and their distances.
+        """
+        return self._index.radius_pairs(X, self.radius, n_jobs=self.n_jobs)
 
     def predict(self, X):
         """Predict the target for the provided data.
 
         Parameters
         ----------
-        X : array-like of shape (n_queries, n_features), \
-                or (n_queries, n_indexed) if metric == 'precomputed'
+        X : array-like of shape (n_queries, n_features)
             Test samples.
 
         Returns
@@ -97,20 +183,59 @@ class FastRadiusRegressor(RadiusNeighborsRegressor):
                 dtype=double
             Target values.
         """
-        neigh_dist, neigh_ind = self.radius_neighbors(X)
+        X = as_float_array(X)
 
         _y = self._y
         if _y.ndim == 1:
             _y = _y.reshape((-1, 1))
 
-        weights = self._get_sparse_weights(len(_y), neigh_dist, neigh_ind)
+        n_queries = len(X)
+        y_pred = np.empty(
+            (n_queries, _y.shape[1]), dtype=np.result_type(X, _y)
+        )
+        norm_factor = np.empty(n_queries)
+        scratch = np.empty(0)
+
+        # queries are processed in chunks with size given by the memory budget
+        n_pairs = 0
+        start = 0
+        # the first chunk fits the budget even if every training sample is a neighbor
+        chunk_size = max(
+            1,
+            min(
+                _INITIAL_CHUNK_SIZE,
+                int(self.max_memory / (_PAIR_NBYTES * len(_y))),
+            ),
+        )
+        while start < n_queries:
+            end = min(n_queries, start + chunk_size)
+            neigh_src, neigh_dst, neigh_dist = self._radius_pairs(X[start:end])
+            weights = _get_flat_weights(neigh_dist, self.weights)
+
+            if len(scratch) < len(neigh_src):
+                scratch = np.empty(
+                    len(neigh_src), dtype=np.result_type(_y, np.float32)
+                )
+
+            _weighted_average(
+                neigh_src,
+                neigh_dst,
+                weights,
+                _y,
+                y_pred[start:end],
+                norm_factor[start:end],
+                scratch[: len(neigh_src)],
+            )
 
-        norm_factor = weights.sum(axis=1)
-        y_pred = weights @ _y
-        with np.errstate(divide="ignore"):
-            y_pred = np.where(norm_factor > 0, y_pred / norm_factor, np.nan)
+            # updating number of neighbors per query estimate
+            n_pairs += len(neigh_src)
+            pairs_per_query = max(n_pairs / end, 1.0)
+            chunk_size = max(
+                1, int(self.max_memory / (_PAIR_NBYTES * pairs_per_query))
+            )
+            start = end
 
-        if np.any(np.isnan(y_pred)):
+        if np.any(norm_factor == 0):
             empty_warning_msg = (
                 "One or more samples have no neighbors "
                 "within specified radius; predicting NaN."
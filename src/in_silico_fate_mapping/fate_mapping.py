@@ -1,13 +1,85 @@
 import functools
-from typing import Callable, Iterable, Optional, Tuple, Union
+import hashlib
+import os
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Callable,
+    Iterable,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import pandas as pd
 import zarr
-from sklearn.neighbors import KNeighborsTransformer, RadiusNeighborsRegressor
+from scipy import sparse
+from sklearn.neighbors import RadiusNeighborsRegressor
 from tqdm import tqdm
 
-from in_silico_fate_mapping.fast_radius_regression import FastRadiusRegressor
+from in_silico_fate_mapping.fast_radius_regression import (
+    FastRadiusRegressor,
+    _get_flat_weights,
+)
+from in_silico_fate_mapping.neighbors import NeighborsIndex, build_index
+
+# maximum number of time points neighbors indices kept outside of fitted models
+INDEX_CACHE_SIZE = 16
+
+# maximum number of displacement field frames kept in memory
+FIELD_CACHE_SIZE = 4
+
+# realizations of each jump kept per voxel
+JUMP_SAMPLES = 64
+
+# time steps of each paths buffer block, sized by the samples still advected
+PATHS_BLOCK_SIZE = 16
+
+
+def _savez_atomic(path: Path, **arrays: np.ndarray) -> None:
+    """Saves `arrays` to a uniquely named temporary file renamed to `path`, so readers never find partial files"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, suffix=".tmp", delete=False
+    ) as f:
+        np.savez(f, **arrays)
+    os.replace(f.name, path)
+
+
+def _compact_ids(ids: np.ndarray) -> np.ndarray:
+    """Casts integral track ids to the smallest of int32 and int64 holding them, others are kept"""
+    if len(ids) == 0 or not np.all(np.mod(ids, 1) == 0):
+        return ids
+    int32 = np.iinfo(np.int32)
+    if int32.min <= ids.min() and ids.max() <= int32.max:
+        return ids.astype(np.int32)
+    return ids.astype(np.int64)
+
+
+def _grid_keys(cells: np.ndarray) -> np.ndarray:
+    """Packs (N, D) integer cells into int64 keys, each coordinate in -2 ** (63 // D - 1) ... 2 ** (63 // D - 1)"""
+    n_bits = 63 // cells.shape[1]
+    shifted = cells.astype(np.int64) + (1 << (n_bits - 1))
+    keys = np.zeros(len(cells), dtype=np.int64)
+    for i in range(cells.shape[1]):
+        keys |= shifted[:, i] << (i * n_bits)
+    return keys
+
+
+def _find_keys(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Rows of `keys` in `sorted_keys`, -1 when missing"""
+    if len(sorted_keys) == 0:
+        return np.full(len(keys), -1)
+    rows = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[rows] == keys, rows, -1)
 
 
 def outdate_fit(method):
@@ -22,17 +94,57 @@ def outdate_fit(method):
 
 
 def update_fit(method):
-    """Recompute fit if necessary"""
+    """Resets models if necessary, they are lazily fitted when requested"""
 
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
         if not self._fitted:
-            self._fit()
+            self._reset_models()
         return method(self, *args, **kwargs)
 
     return wrapper
 
 
+class _ModelStore(dict):
+    """Time point to model mapping that fits each model on first access"""
+
+    def __init__(self, fit_func: Callable[[int], FastRadiusRegressor]) -> None:
+        super().__init__()
+        self._fit_func = fit_func
+
+    def __missing__(self, time: int) -> FastRadiusRegressor:
+        model = self._fit_func(time)
+        self[time] = model
+        return model
+
+
+class _JumpTable:
+    def __init__(self, n_dim: int, rng: np.random.Generator) -> None:
+        """Voxel to `JUMP_SAMPLES` realizations mapping of a jump, sorted by voxel key.
+
+        Parameters
+        ----------
+        n_dim : int
+            Number of spatial dimensions.
+        rng : np.random.Generator
+            Generator of the noise of new realizations.
+        """
+        self.keys = np.empty(0, dtype=np.int64)
+        self.ends = np.empty((0, JUMP_SAMPLES, n_dim), dtype=np.int32)
+        self.alive = np.empty((0, JUMP_SAMPLES), dtype=bool)
+        self.rng = rng
+
+    def add(
+        self, keys: np.ndarray, ends: np.ndarray, alive: np.ndarray
+    ) -> None:
+        """Inserts the realizations of new unique `keys`"""
+        keys = np.concatenate((self.keys, keys))
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ends = np.concatenate((self.ends, ends))[order]
+        self.alive = np.concatenate((self.alive, alive))[order]
+
+
 class FateMapping:
     def __init__(
         self,
@@ -44,6 +156,16 @@ class FateMapping:
         heatmap: bool = False,
         n_samples: int = 25,
         bind_to_existing: bool = True,
+        n_workers: int = 8,
+        cache_dir: Optional[Union[str, Path]] = None,
+        max_memory: int = 2**30,
+        backend: str = "auto",
+        dtype: Union[str, np.dtype, type] = np.float64,
+        transport: bool = False,
+        grid_spacing: Optional[float] = None,
+        heatmap_store: Optional[Union[str, Path, MutableMapping]] = None,
+        heatmap_chunks: Optional[Tuple[int, ...]] = None,
+        crop_heatmap: bool = False,
     ) -> None:
         """
         Simulates a fate map experiment from a set of tracks by interpolating coordinates at each time step.
@@ -66,17 +188,62 @@ class FateMapping:
             Number of samples per individual coordinate, by default 25
         bind_to_existing : bool, optional
             Binds sample to existing data point at starting time, by default True
+        n_workers : int, optional
+            Number of threads fitting models in parallel, also used by neighbors searches of
+            the "ckdtree" backend, by default 8
+        cache_dir : Optional[Union[str, Path]], optional
+            Directory to store fitted models and reuse them between runs, by default None
+        max_memory : int, optional
+            Approximated memory budget in bytes of each chunk of interpolated samples, by default 1GB
+        backend : str, optional
+            Neighbors search backend, one of "auto", "ckdtree", "kd_tree", "brute" or "grid", by default "auto"
+        dtype : Union[str, np.dtype, type], optional
+            Floating point type of tracks, models and paths, by default np.float64
+        transport : bool, optional
+            Propagates the sources probability mass between detections with sparse transport
+            matrices instead of sampling paths, requires `heatmap`, by default False
+        grid_spacing : Optional[float], optional
+            When provided, models are sampled into displacement fields on the grid points
+            within `radius` of each frame detections with this spacing, and coordinates are
+            interpolated with multilinear lookups, by default None
+        heatmap_store : Optional[Union[str, Path, MutableMapping]], optional
+            Zarr store or path where heatmaps are written frame by frame, overwriting previous
+            results, by default None (in memory)
+        heatmap_chunks : Optional[Tuple[int, ...]], optional
+            Heatmap chunks shape, by default one time point and 64 voxels along each spatial axis
+        crop_heatmap : bool, optional
+            Crops the heatmap to the bounding box of the paths, its origin is stored at the
+            "translate" attribute, by default False
         """
         self._base_colnames = ["TrackID", "t", "y", "x"]
         self._spatial_columns = ["y", "x"]
+        self.cache_dir = cache_dir
+        self.grid_spacing = grid_spacing
+        self.max_memory = max_memory
+        self.backend = backend
+        self.dtype = dtype
+        self.n_workers = n_workers
         self.reverse = reverse
         self.radius = radius
         self.data = data
         self.sigma = sigma
         self.weights = weights
         self.heatmap = heatmap
+        self.heatmap_store = heatmap_store
+        self.heatmap_chunks = heatmap_chunks
+        self.crop_heatmap = crop_heatmap
         self.n_samples = n_samples
         self.bind_to_existing = bind_to_existing
+        self.transport = transport
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_frame_indices_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._frame_indices_lock = threading.Lock()
 
     def _validate_data(
         self, value: Union[np.ndarray, pd.DataFrame]
@@ -120,23 +287,88 @@ class FateMapping:
         return value
 
     @property
-    def data(self) -> pd.DataFrame:
-        return self._data
+    def data(self) -> Optional[pd.DataFrame]:
+        """Tracking data rebuilt from the indexed detections, sorted by time"""
+        if self._coords is None:
+            return None
+        times = np.repeat(
+            np.arange(self._tmin, self._tmax + 1), np.diff(self._frame_offsets)
+        )
+        data = pd.DataFrame(self._coords, columns=self._spatial_columns)
+        data.insert(0, "t", times)
+        data.insert(0, "TrackID", self._track_ids)
+        return data
 
     @data.setter
     def data(self, value: Optional[pd.DataFrame]) -> None:
-        """Sets tracking data"""
+        """Sets tracking data, only its indexed detections are kept"""
         self._fitted = False
-        self._models = {}
+        self._models = _ModelStore(self._fit_model)
+        self._reset_derived()
+        self._frame_indices = OrderedDict()
+        self._frame_indices_lock = threading.Lock()
+        # forward and reverse targets of every detection, when precomputed
+        self._targets = None
 
         if value is None:
-            self._data = value
+            self._coords = None
+            self._track_ids = None
+            self._data_hash = None
             return
 
-        self._data = self._validate_data(value)
-        self._tmin = int(round(self._data["t"].min()))
-        self._tmax = int(round(self._data["t"].max()))
-        self._tracks_by_time = self._data.groupby("t")
+        value = self._validate_data(value)
+        self._data_hash = self._hash_data(value)
+        self._tmin = int(round(value["t"].min()))
+        self._tmax = int(round(value["t"].max()))
+        self._index_detections(value)
+
+    def _hash_data(self, value: Union[np.ndarray, pd.DataFrame]) -> str:
+        """Digest of the tracking data columns used by the models"""
+        value = self._validate_data(value)
+        columns = self._base_colnames[:2] + self._spatial_columns
+        hashes = pd.util.hash_pandas_object(value[columns], index=False)
+        return hashlib.sha1(hashes.values).hexdigest()
+
+    def _index_detections(self, data: pd.DataFrame) -> None:
+        """Stores the coordinates contiguously sorted by time, with each
+        time point offsets, and links consecutive detections of the same track
+        """
+        times = np.round(data["t"].values).astype(int)
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        track_ids = _compact_ids(data["TrackID"].values[order])
+        self._track_ids = track_ids
+        self._coords = np.ascontiguousarray(
+            data[self._spatial_columns].values[order], dtype=self.dtype
+        )
+
+        # time point `t` coordinates are at offsets[t - tmin]:offsets[t - tmin + 1]
+        self._frame_offsets = np.searchsorted(
+            times, np.arange(self._tmin, self._tmax + 2)
+        )
+
+        # consecutive rows of the same track sorted by time
+        order = np.lexsort((times, track_ids))
+        src, dst = order[:-1], order[1:]
+        linked = (track_ids[src] == track_ids[dst]) & (
+            times[dst] - times[src] == 1
+        )
+        src, dst = src[linked], dst[linked]
+
+        link_dtype = np.int32 if len(times) < 2**31 else np.int64
+        self._next_rows = np.full(len(times), -1, dtype=link_dtype)
+        self._next_rows[src] = dst
+        self._prev_rows = np.full(len(times), -1, dtype=link_dtype)
+        self._prev_rows[dst] = src
+
+    def _frame(self, time: int) -> slice:
+        """Rows slice of the given time point, empty if outside data range"""
+        if time < self._tmin or time > self._tmax:
+            return slice(0, 0)
+        index = time - self._tmin
+        return slice(
+            self._frame_offsets[index], self._frame_offsets[index + 1]
+        )
 
     @property
     def weights(self) -> str:
@@ -146,98 +378,483 @@ class FateMapping:
     def weights(self, value: str) -> None:
         """Neighborhood weighting for interpolation (knn regression)"""
         self._weights = value
+        self._reset_derived()
         for model in self._models.values():
             model.weights = value
 
+    @property
+    def n_workers(self) -> int:
+        return self._n_workers
+
+    @n_workers.setter
+    def n_workers(self, value: int) -> None:
+        """Number of threads fitting models and searching cKDTree neighbors"""
+        self._n_workers = value
+        for model in self._iter_models():
+            model.n_jobs = value
+
+    @property
+    def max_memory(self) -> int:
+        return self._max_memory
+
+    @max_memory.setter
+    def max_memory(self, value: int) -> None:
+        """Memory budget in bytes of each chunk of interpolated samples"""
+        self._max_memory = value
+        for model in self._iter_models():
+            model.max_memory = value
+
+    @property
+    def backend(self) -> str:
+        return self._backend
+
+    @backend.setter
+    @outdate_fit
+    def backend(self, value: str) -> None:
+        """Neighbors search backend"""
+        self._backend = value
+        self._frame_indices = OrderedDict()
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @dtype.setter
+    @outdate_fit
+    def dtype(self, value: Union[str, np.dtype, type]) -> None:
+        """Floating point type of computations"""
+        value = np.dtype(value)
+        if value not in (np.float32, np.float64):
+            raise ValueError(
+                f"dtype must be float32 or float64. Found {value}"
+            )
+        self._dtype = value
+        self._frame_indices = OrderedDict()
+        if getattr(self, "_coords", None) is not None:
+            self._coords = self._coords.astype(value)
+
+    @property
+    def grid_spacing(self) -> Optional[float]:
+        return self._grid_spacing
+
+    @grid_spacing.setter
+    def grid_spacing(self, value: Optional[float]) -> None:
+        """Displacement field grid spacing, fields are sampled again when changed"""
+        if value is not None and value <= 0:
+            raise ValueError(f"grid_spacing must be positive. Found {value}")
+        self._grid_spacing = value
+        self._reset_derived()
+
     @property
     def radius(self) -> float:
         return self._radius
 
     @radius.setter
-    @outdate_fit
     def radius(self, value: float) -> None:
         """Neighborhood radius for interpolation (knn regression)"""
         self._radius = value
+        self._reset_derived()
+        # radius is only a query parameter, neighbors indices are kept
+        for model in getattr(self, "_models", {}).values():
+            model.radius = value
 
     @property
     def reverse(self) -> bool:
         return self._reverse
 
     @reverse.setter
-    @outdate_fit
     def reverse(self, value: bool) -> None:
-        """Sets interpolation direction"""
+        """Sets interpolation direction, models store both directions"""
         self._reverse = value
 
-    def _fit(self) -> None:
-        """Fits a model for each time point"""
-        if self._data is None:
+    def _reset_derived(self) -> None:
+        """Discards transport matrices, jump tables and displacement fields derived from the models"""
+        self._transports = {}
+        self._jumps = {}
+        self._field_frames = OrderedDict()
+
+    def _iter_models(self) -> Iterable[FastRadiusRegressor]:
+        """Iterates over the fitted time point models"""
+        yield from getattr(self, "_models", {}).values()
+
+    def _reset_models(self) -> None:
+        """Discards outdated models, new ones are fitted on demand"""
+        if self._coords is None:
             raise ValueError("Data must be set before executing Fate Mapping")
 
-        self._models = {
-            t: self._fit_model(t)
-            for t in tqdm(self.time_iter(), "Fitting interpolation")
-        }
+        self._models = _ModelStore(self._fit_model)
+        self._reset_derived()
         self._fitted = True
 
-    def _fit_model(self, time: int) -> RadiusNeighborsRegressor:
-        """Fits the interpolation model to the given time point"""
+    def _fit(self, times: Optional[Iterable[int]] = None) -> None:
+        """Fits the models of the given time points in parallel, all of them by default"""
+        if not self._fitted:
+            self._reset_models()
+
+        if times is None:
+            times = range(self._tmin, self._tmax + 1)
 
-        # merge consecutive time points
-        df = pd.concat(
-            (
-                self._tracks_by_time.get_group(time),
-                self._tracks_by_time.get_group(time + self.step),
-            )
-        )
+        missing = [t for t in times if t not in self._models]
+        if len(missing) == 0:
+            return
 
-        # find tracks belonging to both of them (connections)
-        connected = df.groupby("TrackID").size() > 1
-        connected = connected[df["TrackID"]].values
-
-        # compute source (X) and target (Y) pairs from connections
-        conn_df = df.loc[connected]
-        if conn_df.shape[0] > 0:
-            conn_df = conn_df.sort_values(by=["TrackID", "t"])
-            values = conn_df[self._spatial_columns].values
-            X = values[::2]
-            Y = values[1::2]
-            if self.reverse:
-                X, Y = Y, X
+        # models are fitted single-threaded inside the pool to avoid oversubscription
+        fit_model = functools.partial(self._fit_model, n_jobs=1)
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            models = executor.map(fit_model, missing)
+            for t, model in zip(
+                missing,
+                tqdm(models, "Fitting interpolation", total=len(missing)),
+            ):
+                model.n_jobs = self.n_workers
+                self._models[t] = model
+
+    def _fit_ahead(self, times: Sequence[int]) -> None:
+        """Fits in parallel the models of the first `n_workers` upcoming `times` when the first one is missing,
+        so only models of time points actually stepped through are fitted
+        """
+        if len(times) > 0 and times[0] not in self._models:
+            self._fit(times[: self.n_workers])
+
+    def _cache_path(self) -> Optional[Path]:
+        """Cache directory of current data, None if caching is disabled"""
+        if self.cache_dir is None:
+            return None
+
+        columns = self._base_colnames[:2] + self._spatial_columns
+        key = f"{self._data_hash}-{columns}-{self.dtype}"
+        return Path(self.cache_dir) / hashlib.sha1(key.encode()).hexdigest()
+
+    def _fit_model(
+        self, time: int, n_jobs: Optional[int] = None
+    ) -> RadiusNeighborsRegressor:
+        """Fits the interpolation model to the given time point, loading its pairs from cache if available.
+
+        Neighbors are queried with `n_jobs` threads, `n_workers` by default.
+        """
+        if n_jobs is None:
+            n_jobs = self.n_workers
+
+        cache_path = self._cache_path()
+
+        if cache_path is None:
+            X, Y = self._fit_pairs(time, n_jobs)
         else:
-            X, Y = None, None
-
-        # connect disconnected pairs to their nearest neighbors in the subsequent time point
-        split_df = df.loc[np.logical_not(connected)]
-        split_df = split_df[split_df["t"] == time][
-            self._spatial_columns
-        ].values
-        next_df = self._tracks_by_time.get_group(time + self.step)[
-            self._spatial_columns
-        ].values
-        if split_df.shape[0] > 0 and next_df.shape[0] > 0:
-            nn = KNeighborsTransformer(n_neighbors=1)
-            nn.fit(next_df)
-            neighbors = nn.kneighbors(
-                split_df, return_distance=False
-            ).squeeze()
-
-            if X is None:
-                X = (split_df,)
-                Y = next_df[neighbors]
+            path = cache_path / f"{time}.npz"
+            if path.exists():
+                with np.load(path) as arrays:
+                    X, Y = arrays["X"], arrays["Y"]
             else:
-                X = np.concatenate((X, split_df), axis=0)
-                Y = np.concatenate((Y, next_df[neighbors]), axis=0)
+                X, Y = self._fit_pairs(time, n_jobs)
+                _savez_atomic(path, X=X, Y=Y)
 
         # build regression model
         return FastRadiusRegressor(
             radius=self.radius,
             weights=self.weights,
-            algorithm="kd_tree",
-            leaf_size=5,
-            n_jobs=8,
+            algorithm=self.backend,
+            n_jobs=n_jobs,
+            max_memory=self.max_memory,
         ).fit(X, Y)
 
+    def _fit_pairs(
+        self, time: int, n_jobs: int = 1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Computes sources (X) and their forward and backward targets (Y) from the given time point"""
+        rows = self._frame(time)
+        X = self._coords[rows]
+        if self._targets is not None:
+            return X, self._targets[rows]
+
+        # forward and reverse targets are stacked along the 1-axis
+        Y = np.concatenate(
+            (
+                self._link(X, self._next_rows[rows], time + 1, n_jobs),
+                self._link(X, self._prev_rows[rows], time - 1, n_jobs),
+            ),
+            axis=1,
+        )
+        return X, Y
+
+    def _link(
+        self, coords: np.ndarray, links: np.ndarray, time: int, n_jobs: int = 1
+    ) -> np.ndarray:
+        """Finds the linked coordinates at `time` given the links rows.
+
+        Unlinked coordinates (-1) are connected to their nearest neighbor
+        and NaN is returned if no data exists at `time`.
+        """
+        other = self._coords[self._frame(time)]
+        if len(other) == 0:
+            return np.full(coords.shape, np.nan, dtype=coords.dtype)
+
+        targets = self._coords[links]
+
+        # connect disconnected pairs to their nearest neighbors in the other time point
+        disconnected = links < 0
+        if np.any(disconnected):
+            neighbors = self._frame_index(time).query(
+                coords[disconnected], k=1, n_jobs=n_jobs
+            )[:, 0]
+            targets[disconnected] = other[neighbors]
+
+        return targets
+
+    def _frame_index(self, time: int) -> NeighborsIndex:
+        """Neighbors index of the given time point coordinates.
+
+        The fitted model index is used when available, otherwise indices
+        are built and kept in a least recently used cache.
+        """
+        model = self._models.get(time)
+        if model is not None:
+            return model._index
+
+        with self._frame_indices_lock:
+            if time in self._frame_indices:
+                self._frame_indices.move_to_end(time)
+                return self._frame_indices[time]
+
+        index = build_index(self._coords[self._frame(time)], self.backend)
+
+        with self._frame_indices_lock:
+            self._frame_indices[time] = index
+            if len(self._frame_indices) > INDEX_CACHE_SIZE:
+                self._frame_indices.popitem(last=False)
+
+        return index
+
+    def _predict(self, time: int, X: np.ndarray) -> np.ndarray:
+        """Interpolates `X` coordinates from `time` to the next time point in the current direction"""
+        n_dim = len(self._spatial_columns)
+        if self.grid_spacing is None:
+            Y = self._models[time].predict(X)
+        else:
+            Y = self._interpolate_field(time, X)
+        return Y[:, n_dim:] if self.reverse else Y[:, :n_dim]
+
+    def _field_cells(self, time: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted keys of the unique grid cells within `radius` of `time` detections and the (N, D) cells"""
+        X = self._coords[self._frame(time)]
+        n_dim = X.shape[1]
+        spacing = self.grid_spacing
+        reach = int(np.ceil(self.radius / spacing)) + 1
+        offsets = np.indices((2 * reach + 1,) * n_dim).reshape((n_dim, -1)).T
+        offsets -= reach
+
+        # candidate cells of detections chunks to bound memory
+        chunk_size = max(1, self.max_memory // (len(offsets) * n_dim * 32))
+        keys, cells = [], []
+        for start in range(0, len(X), chunk_size):
+            chunk = X[start : start + chunk_size]
+            candidates = np.floor(chunk / spacing).astype(np.int64)
+            candidates = candidates[:, np.newaxis] + offsets
+            dist = np.linalg.norm(
+                candidates * spacing - chunk[:, np.newaxis], axis=-1
+            )
+            candidates = candidates[dist <= self.radius]
+            chunk_keys, first = np.unique(
+                _grid_keys(candidates), return_index=True
+            )
+            keys.append(chunk_keys)
+            cells.append(candidates[first])
+
+        if len(keys) == 0:
+            return np.empty(0, np.int64), np.empty((0, n_dim), np.int64)
+        keys, first = np.unique(np.concatenate(keys), return_index=True)
+        return keys, np.concatenate(cells)[first]
+
+    def _sample_field(self, time: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted keys of the defined grid cells of `time` and their forward and reverse displacements"""
+        keys, cells = self._field_cells(time)
+        if len(cells) == 0:
+            return keys, np.empty((0, 2 * cells.shape[1]), self.dtype)
+
+        grid = cells * np.asarray(self.grid_spacing, self.dtype)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            Y = self._models[time].predict(grid)
+        Y -= np.tile(grid, 2)
+
+        defined = self._valid_rows(Y)
+        return keys[defined], Y[defined]
+
+    def _displacement_field(self, time: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Displacement field of `time` model sampled on the grid, computed on first request.
+
+        Fields are kept in a least recently used cache and stored at the cache directory if available.
+        """
+        if time in self._field_frames:
+            self._field_frames.move_to_end(time)
+            return self._field_frames[time]
+
+        cache_path = self._cache_path()
+        if cache_path is None:
+            field = self._sample_field(time)
+        else:
+            key = f"{self.grid_spacing}-{self.radius}-{self.weights}"
+            key = hashlib.sha1(key.encode()).hexdigest()
+            path = cache_path / f"field-{key}" / f"{time}.npz"
+            if path.exists():
+                with np.load(path) as arrays:
+                    field = arrays["keys"], arrays["values"]
+            else:
+                field = self._sample_field(time)
+                _savez_atomic(path, keys=field[0], values=field[1])
+
+        self._field_frames[time] = field
+        if len(self._field_frames) > FIELD_CACHE_SIZE:
+            self._field_frames.popitem(last=False)
+        return field
+
+    def _interpolate_field(self, time: int, X: np.ndarray) -> np.ndarray:
+        """Interpolates forward and reverse targets of `X` with multilinear lookups of `time` displacement field.
+
+        Rows with an undefined surrounding grid point are interpolated by the model instead.
+        """
+        keys, values = self._displacement_field(time)
+        X = np.asarray(X)
+        if len(keys) == 0:
+            return self._models[time].predict(X)
+
+        coords = X / self.grid_spacing
+        lower = np.floor(coords).astype(np.int64)
+        frac = coords - lower
+
+        Y = np.zeros((len(X), values.shape[1]), dtype=values.dtype)
+        defined = np.ones(len(X), dtype=bool)
+        for corner in np.ndindex(*((2,) * X.shape[1])):
+            rows = _find_keys(keys, _grid_keys(lower + corner))
+            weights = np.prod(np.where(corner, frac, 1 - frac), axis=1)
+            Y += weights[:, np.newaxis] * values[rows]
+            defined &= rows >= 0
+
+        Y += np.tile(X, 2)
+        if not np.all(defined):
+            Y[~defined] = self._models[time].predict(X[~defined])
+        return Y
+
+    def _jump_table(self, time: int, level: int) -> _JumpTable:
+        """Realizations table of jumps from `time` 2 ** `level` time points ahead in the current direction"""
+        key = (time, level, self.step, self.sigma)
+        table = self._jumps.get(key)
+        if table is None:
+            # seeded by jump so composed tables are reproducible
+            rng = np.random.default_rng(
+                np.random.SeedSequence(
+                    42, spawn_key=(time - self._tmin, level, int(self.reverse))
+                )
+            )
+            table = _JumpTable(len(self._spatial_columns), rng)
+            self._jumps[key] = table
+        return table
+
+    def _jump_realizations(
+        self, time: int, level: int, voxels: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """(N, JUMP_SAMPLES, D) jump ends from `voxels` and whether they stayed inside the data support,
+        realizations of new voxels are composed on demand.
+        """
+        table = self._jump_table(time, level)
+        keys = _grid_keys(voxels)
+        rows = _find_keys(table.keys, keys)
+        missing = rows < 0
+        if np.any(missing):
+            new_keys, first = np.unique(keys[missing], return_index=True)
+            ends, alive = self._compose_jump(
+                time, level, voxels[missing][first], table.rng
+            )
+            table.add(new_keys, ends, alive)
+            rows = _find_keys(table.keys, keys)
+        return table.ends[rows], table.alive[rows]
+
+    def _compose_jump(
+        self,
+        time: int,
+        level: int,
+        voxels: np.ndarray,
+        rng: np.random.Generator,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples `JUMP_SAMPLES` realizations of the jump from each voxel.
+
+        Single time point jumps step as the stepwise advection does, truncating positions to the voxel grid,
+        longer ones chain each realization of the first half jump with a random one of the second half.
+        Samples leaving the data support keep their last position.
+        """
+        n_voxels, n_dim = voxels.shape
+        if level == 0:
+            ends = np.repeat(voxels, JUMP_SAMPLES, axis=0).astype(np.int32)
+            Y, alive = self._jump(time, 0, ends, rng)
+            ends[alive] = Y[alive]
+        else:
+            ends, alive = self._jump_realizations(time, level - 1, voxels)
+            ends = ends.reshape((-1, n_dim))
+            alive = alive.ravel()
+            if np.any(alive):
+                half = time + self.step * 2 ** (level - 1)
+                Y, still_alive = self._jump(half, level - 1, ends[alive], rng)
+                ends[alive] = Y
+                alive[alive] = still_alive
+
+        return (
+            ends.reshape((n_voxels, JUMP_SAMPLES, n_dim)),
+            alive.reshape((n_voxels, JUMP_SAMPLES)),
+        )
+
+    def _jump(
+        self, time: int, level: int, X: np.ndarray, rng: np.random.Generator
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples the positions of `X` coordinates 2 ** `level` time points ahead and whether
+        they stayed inside the data support, otherwise their positions are the last ones inside it.
+
+        Single time point steps add noise before interpolating, longer jumps draw a random realization
+        of the voxel of each row.
+        """
+        if level == 0:
+            noise = self._get_noise_function(X.shape, rng)(len(X))
+            Y = self._predict(time, np.add(X, noise, dtype=self.dtype))
+            alive = self._valid_rows(Y)
+            Y[~alive] = X[~alive]
+            return Y, alive
+
+        return self._draw_jump(time, level, X, rng)
+
+    def _draw_jump(
+        self, time: int, level: int, X: np.ndarray, rng: np.random.Generator
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Draws the jump ends of `X` coordinates and whether they stayed inside the data support
+        from the realizations of their voxel, including single time point jumps.
+        """
+        voxels = X.astype(np.int64)
+        ends, alive = self._jump_realizations(time, level, voxels)
+
+        # rows of the same voxel take consecutive realizations from a random one, so they are
+        # distinct as long as there are less than JUMP_SAMPLES of them
+        unique_keys, groups = np.unique(
+            _grid_keys(voxels), return_inverse=True
+        )
+        order = np.argsort(groups, kind="stable")
+        ranks = np.empty(len(X), dtype=np.int64)
+        ranks[order] = np.arange(len(X)) - np.searchsorted(
+            groups[order], groups[order]
+        )
+        offsets = rng.integers(JUMP_SAMPLES, size=len(unique_keys))
+        picks = (offsets[groups] + ranks) % JUMP_SAMPLES
+
+        rows = np.arange(len(X))
+        return ends[rows, picks], alive[rows, picks]
+
+    def _jump_iter(self, time_iter: range) -> List[Tuple[int, int]]:
+        """Decomposes `time_iter` into (time, level) jumps of decreasing power of two lengths"""
+        jumps = []
+        time, length = time_iter.start, len(time_iter)
+        while length > 0:
+            level = length.bit_length() - 1
+            jumps.append((time, level))
+            time += self.step * 2**level
+            length -= 2**level
+        return jumps
+
     @property
     def step(self) -> int:
         """Time step"""
@@ -273,53 +890,221 @@ class FateMapping:
 
             return range(t0, tN, self.step)
 
-    def _compute_heatmap(self, paths: np.ndarray) -> zarr.Array:
-        """Accumulates frequency of `path` hits"""
-        shape = np.ceil(paths[:, 1:].max(axis=0)).astype(int) + 1
-        heatmap = zarr.zeros(
+    def _compute_heatmap(
+        self, paths: np.ndarray, weights: Optional[np.ndarray] = None
+    ) -> zarr.Array:
+        """Accumulates frequency of `path` hits, or their `weights` sum if provided.
+
+        The heatmap origin is stored at its "translate" attribute.
+        """
+        coords = np.round(paths[:, 1:]).astype(int)
+        if self.crop_heatmap:
+            translate = coords.min(axis=0)
+            coords -= translate
+            shape = coords.max(axis=0) + 1
+        else:
+            translate = np.zeros(coords.shape[1], dtype=int)
+            shape = np.ceil(paths[:, 1:].max(axis=0)).astype(int) + 1
+
+        dtype = np.int32 if weights is None else np.float32
+        chunks = self.heatmap_chunks
+        if chunks is None:
+            chunks = np.minimum((1,) + (len(shape) - 1) * (64,), shape)
+
+        store = self.heatmap_store
+        if store is None:
+            store = zarr.MemoryStore()
+        elif isinstance(store, Path):
+            store = str(store)
+
+        heatmap = zarr.open_array(
+            store=store,
+            mode="w",
             shape=shape,
-            dtype=np.int32,
-            store=zarr.MemoryStore(),
-            chunks=(1,) + (len(shape) - 1) * (64,),
+            dtype=dtype,
+            chunks=chunks,
+            fill_value=0,
         )
-        df = self._validate_data(paths)
-        for t, group in tqdm(df.groupby("t"), "Computing heatmap"):
-            coords = group[self._spatial_columns].round().astype(int)
-            coords["w"] = 1
-            coords = coords.groupby(
-                self._spatial_columns, as_index=False
-            ).sum()
-            heatmap.vindex[
-                (int(round(t)),)
-                + tuple(coords[self._spatial_columns].values.T)
-            ] = coords["w"]
+        heatmap.attrs["translate"] = translate.tolist()
+
+        # hits are reduced by their flat voxel index, discarding negative coordinates
+        inside = np.all(coords >= 0, axis=1)
+        flat = np.ravel_multi_index(tuple(coords[inside].T), shape)
+        voxels, inverse = np.unique(flat, return_inverse=True)
+        values = np.bincount(
+            inverse, None if weights is None else weights[inside]
+        ).astype(dtype)
+
+        # sorted voxels are contiguous per frame, each frame bounding box is written once
+        frame_size = np.prod(shape[1:])
+        offsets = np.searchsorted(voxels, np.arange(shape[0] + 1) * frame_size)
+        for t in tqdm(range(shape[0]), "Computing heatmap"):
+            start, end = offsets[t], offsets[t + 1]
+            if start == end:
+                continue
+            frame_coords = np.asarray(
+                np.unravel_index(voxels[start:end] - t * frame_size, shape[1:])
+            )
+            lower = frame_coords.min(axis=1)
+            upper = frame_coords.max(axis=1) + 1
+            frame = np.zeros(upper - lower, dtype=dtype)
+            frame[tuple(frame_coords - lower[:, np.newaxis])] = values[
+                start:end
+            ]
+            heatmap[(t,) + tuple(map(slice, lower, upper))] = frame
+
         return heatmap
 
+    def _transport_matrix(self, time: int) -> sparse.csr_matrix:
+        """Row-stochastic transport matrix from `time` detections to the next time point detections.
+
+        Each detection is interpolated to the next time point in the current direction
+        and its mass is split among the detections within radius, proportionally to the
+        interpolation weights. Rows of detections leaving the data support are empty.
+        """
+        key = (time, self.step)
+        if key in self._transports:
+            return self._transports[key]
+
+        next_time = time + self.step
+        X = self._coords[self._frame(time)]
+        n_next = self._frame(next_time).stop - self._frame(next_time).start
+
+        Y = self._predict(time, X)
+        rows = np.nonzero(self._valid_rows(Y))[0]
+        src, dst, dist = self._frame_index(next_time).radius_pairs(
+            Y[rows], self.radius, n_jobs=self.n_workers
+        )
+        weights = _get_flat_weights(dist, self.weights)
+        weights /= np.bincount(src, weights, minlength=len(rows))[src]
+
+        matrix = sparse.csr_matrix(
+            (weights.astype(self.dtype), (rows[src], dst)),
+            shape=(len(X), n_next),
+        )
+        self._transports[key] = matrix
+        return matrix
+
+    def _source_mass(self, source: np.ndarray) -> np.ndarray:
+        """Distributes unit mass of each source among its detections within radius.
+
+        Sources without detections within radius are bound to their nearest detection.
+        """
+        time = int(round(source[0, 0]))
+        X = np.asarray(source[:, 1:], dtype=self.dtype)
+        index = self._frame_index(time)
+
+        src, dst, dist = index.radius_pairs(
+            X, self.radius, n_jobs=self.n_workers
+        )
+        weights = _get_flat_weights(dist, self.weights)
+        norm = np.bincount(src, weights, minlength=len(X))
+
+        isolated = np.nonzero(norm == 0)[0]
+        if len(isolated) > 0:
+            nearest = index.query(X[isolated], k=1, n_jobs=self.n_workers)
+            src = np.concatenate((src, isolated))
+            dst = np.concatenate((dst, nearest[:, 0]))
+            weights = np.concatenate((weights, np.ones(len(isolated))))
+            norm[isolated] = 1
+
+        return np.bincount(
+            dst, weights / norm[src], minlength=len(index.data)
+        ).astype(self.dtype)
+
+    def _propagate(self, source: np.ndarray) -> zarr.Array:
+        """Propagates the sources probability mass and accumulates it into a heatmap"""
+        if not self.heatmap:
+            raise ValueError(
+                "Mass transport only computes heatmaps, `heatmap` must be True"
+            )
+
+        t0 = int(round(source[0, 0]))
+        time_iter = self.time_iter(t0=t0)
+
+        mass = self._source_mass(source)
+        points, weights = [], []
+
+        for i, t in enumerate(
+            tqdm([t0] + [t + self.step for t in time_iter], "Propagating mass")
+        ):
+            if t != t0:
+                self._fit_ahead(time_iter[i - 1 :])
+                mass = self._transport_matrix(t - self.step).T @ mass
+            visited = np.nonzero(mass)[0]
+            if len(visited) == 0:
+                break
+            coords = self._coords[self._frame(t)][visited]
+            points.append(
+                np.concatenate(
+                    (
+                        np.zeros((len(visited), 1)),
+                        np.full((len(visited), 1), t),
+                        coords,
+                    ),
+                    axis=1,
+                )
+            )
+            weights.append(mass[visited])
+
+        return self._compute_heatmap(
+            np.concatenate(points, axis=0), np.concatenate(weights)
+        )
+
     @staticmethod
     def _valid_rows(pos: np.ndarray) -> np.ndarray:
-        """Returns mask of rows with no nan values"""
-        return np.logical_not(np.any(np.isnan(pos), axis=1))
-
-    def _as_track(self, t: int, pos: np.ndarray) -> np.ndarray:
-        """Converts coordinates and time to tracks format"""
-        t = np.full(pos.shape[0], t)[:, np.newaxis]
-        track_ids = np.arange(1, 1 + pos.shape[0])[:, np.newaxis]
-        tracks = np.concatenate((track_ids, t, pos), axis=1)
-        return tracks[self._valid_rows(pos)]
-
-    def _get_noise_function(self, shape: Tuple[int]) -> Callable:
-        """Noise or dummy function given sigma"""
+        """Returns mask of rows (last axis) with no nan values"""
+        return np.logical_not(np.any(np.isnan(pos), axis=-1))
+
+    def _as_tracks(
+        self, t0: int, blocks: List[Tuple[np.ndarray, int, np.ndarray]]
+    ) -> np.ndarray:
+        """Converts blocks of (rows, first step, (n, B, D) paths) starting at `t0` to tracks format
+        sorted by track id and time"""
+        track_ids, steps, pos = [], [], []
+        for rows, start, paths in blocks:
+            block_rows, block_steps = np.nonzero(self._valid_rows(paths))
+            track_ids.append(rows[block_rows])
+            steps.append(start + block_steps)
+            pos.append(paths[block_rows, block_steps])
+
+        track_ids = np.concatenate(track_ids)
+        times = t0 + self.step * np.concatenate(steps)
+        if self.reverse:
+            order = np.lexsort((times, track_ids))
+        else:
+            # blocks are in step order, a stable sort by track keeps steps sorted
+            order = np.argsort(track_ids, kind="stable")
+        return np.concatenate(
+            (
+                track_ids[order, np.newaxis] + 1,
+                times[order, np.newaxis],
+                np.concatenate(pos)[order],
+            ),
+            axis=1,
+            dtype=self.dtype,
+        )
+
+    def _get_noise_function(
+        self, shape: Tuple[int], rng: Optional[np.random.Generator] = None
+    ) -> Callable:
+        """Noise or dummy function given sigma, returns noise for the first `n` rows of `shape`"""
         if self.sigma == 0.0:
-            zeros = np.zeros(shape, dtype=np.float32)
+            zeros = np.zeros(shape, dtype=self.dtype)
 
-            def _fun():
-                return zeros
+            def _fun(n: int) -> np.ndarray:
+                return zeros[:n]
 
         else:
-            rng = np.random.default_rng(42)
+            if rng is None:
+                rng = np.random.default_rng(42)
 
-            def _fun():
-                return rng.normal(scale=self.sigma, size=shape)
+            def _fun(n: int) -> np.ndarray:
+                noise = rng.standard_normal(
+                    size=(n,) + shape[1:], dtype=self.dtype
+                )
+                noise *= self.sigma
+                return noise
 
         return _fun
 
@@ -328,16 +1113,20 @@ class FateMapping:
         samples = []
         for t in np.unique(coords[:, 0]):
             current = coords[coords[:, 0] == t]
-            df = self._tracks_by_time.get_group(int(round(t)))
-            X = df[["t"] + self._spatial_columns].values
-            nn = KNeighborsTransformer(n_neighbors=self.n_samples).fit(
-                X[:, 1:]
+            time = int(round(t))
+            X = self._coords[self._frame(time)]
+            neighbors = (
+                self._frame_index(time)
+                .query(current[:, 1:], k=self.n_samples, n_jobs=self.n_workers)
+                .reshape(-1)
+            )
+            samples.append(
+                np.concatenate(
+                    (np.full((len(neighbors), 1), time), X[neighbors]),
+                    axis=1,
+                )
             )
-            neighbors = nn.kneighbors(
-                current[:, 1:], return_distance=False
-            ).reshape(-1)
-            samples.append(X[neighbors])
-        return np.concatenate(samples, axis=0, dtype=float)
+        return np.concatenate(samples, axis=0, dtype=self.dtype)
 
     def _sample_sources(self, coords: np.ndarray) -> np.ndarray:
         """Samples `n_samples` per coordinate"""
@@ -348,8 +1137,8 @@ class FateMapping:
             coords = np.repeat(coords, repeats=self.n_samples, axis=0)
         return coords
 
-    def _preprocess_source(self, source: np.ndarray) -> np.ndarray:
-        """Validates and sample source if necessary"""
+    def _validate_source(self, source: np.ndarray) -> np.ndarray:
+        """Sanity checks the source coordinates"""
         source = np.atleast_2d(source)
 
         if source.ndim > 2:
@@ -366,7 +1155,11 @@ class FateMapping:
         if np.any(source[:, 0] != t0):
             raise ValueError("All sources must belong to the same time point")
 
-        return self._sample_sources(source)
+        return source
+
+    def _preprocess_source(self, source: np.ndarray) -> np.ndarray:
+        """Validates and sample source if necessary"""
+        return self._sample_sources(self._validate_source(source))
 
     @update_fit
     def __call__(self, source: np.ndarray) -> Union[zarr.Array, np.ndarray]:
@@ -382,24 +1175,44 @@ class FateMapping:
         np.ndarray
             (N, D + 1) first column is the TrackID of each source
         """
+        if self.transport:
+            return self._propagate(self._validate_source(source))
+
         source = self._preprocess_source(source)
         t0 = source[0, 0]
 
-        pos = np.asarray(source[:, 1:])
+        pos = np.asarray(source[:, 1:], dtype=self.dtype)
         shape = pos.shape
 
         _noise = self._get_noise_function(shape)
 
-        paths = [self._as_track(t0, pos)]
-        for t in tqdm(self.time_iter(t0=int(round(t0))), "Computing paths"):
-            valid = self._valid_rows(pos)
-            X = (pos + _noise())[valid]
-            if len(X) == 0:
+        time_iter = self.time_iter(t0=int(round(t0)))
+
+        # paths are written into blocks of `PATHS_BLOCK_SIZE` steps holding only the samples
+        # advected when the block starts, NaN after leaving the data support
+        blocks = [(np.arange(shape[0]), 0, pos[:, np.newaxis].copy())]
+
+        # only samples inside the data support (active) are advected
+        active = np.nonzero(self._valid_rows(pos))[0]
+        pos = pos[active]
+
+        for i, t in enumerate(tqdm(time_iter, "Computing paths"), start=1):
+            if len(pos) == 0:
                 break
-            pos[valid] = self._models[t].predict(X)
-            paths.append(self._as_track(t + self.step, pos))
+            self._fit_ahead(time_iter[i - 1 :])
+            pos = self._predict(t, pos + _noise(len(pos)))
+            if (i - 1) % PATHS_BLOCK_SIZE == 0:
+                length = min(PATHS_BLOCK_SIZE, len(time_iter) - i + 1)
+                buffer = np.full(
+                    (len(active), length, shape[1]), np.nan, dtype=self.dtype
+                )
+                blocks.append((active, i, buffer))
+            valid = self._valid_rows(pos)
+            active, pos = active[valid], pos[valid]
+            # active rows are sorted subsets of the block rows
+            rows, start, buffer = blocks[-1]
+            buffer[np.searchsorted(rows, active), i - start] = pos
 
-        paths = np.concatenate(paths, axis=0)
-        paths = paths[np.lexsort((paths[:, 1], paths[:, 0]))]
+        paths = self._as_tracks(t0, blocks)
 
         return self._compute_heatmap(paths) if self.heatmap else paths
@@ -0,0 +1,394 @@
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.neighbors import KDTree
+
+# frames up to this size are searched by brute force on "auto" mode
+BRUTE_FORCE_MAX_SIZE = 256
+
+# kd-trees degrade to brute force on high dimensional data
+TREE_MAX_DIM = 10
+
+# maximum number of (query, data) distances computed at once by brute force
+_BRUTE_FORCE_BLOCK_SIZE = 2**20
+
+# minimum number of queries searched by each thread
+_MIN_THREAD_BLOCK_SIZE = 1024
+
+# grids with more cells fall back to a cKDTree, keeping their linear keys within int64
+_GRID_MAX_CELLS = 2**62
+
+
+def as_float_array(X: np.ndarray) -> np.ndarray:
+    """Converts to a floating point array, single precision is kept"""
+    X = np.asarray(X)
+    if X.dtype not in (np.float32, np.float64):
+        X = X.astype(np.float64)
+    return X
+
+
+def n_threads(n_jobs: Optional[int]) -> int:
+    """Number of threads given scikit-learn's `n_jobs` convention, negative values count back from the CPUs"""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def _empty_pairs() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Empty query indices, data indices and distances"""
+    return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
+
+
+class NeighborsIndex(ABC):
+    def __init__(self, data: np.ndarray, leaf_size: int = 5) -> None:
+        """
+        Neighbors search structure of a fixed set of coordinates.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            (N, D) indexed coordinates.
+        leaf_size : int, optional
+            Leaf size of tree based indices, by default 5
+        """
+        self.data = as_float_array(data)
+        self.leaf_size = leaf_size
+
+    def _check_k(self, k: int) -> None:
+        """Raises the same error on every backend when there are fewer data points than `k`"""
+        if k > len(self.data):
+            raise ValueError(
+                f"k must be less than or equal to the number of data points. Found {k} and {len(self.data)}"
+            )
+
+    @abstractmethod
+    def radius_pairs(
+        self, X: np.ndarray, radius: float, n_jobs: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Finds every (query, data) pair within `radius` as flat arrays.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            (M, D) query coordinates.
+        radius : float
+            Search radius.
+        n_jobs : Optional[int], optional
+            Number of threads used when supported, by default None
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray]
+            Query indices, data indices and their distances.
+        """
+
+    @abstractmethod
+    def query(
+        self, X: np.ndarray, k: int, n_jobs: Optional[int] = None
+    ) -> np.ndarray:
+        """Finds the `k` nearest neighbors of each query.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            (M, D) query coordinates.
+        k : int
+            Number of neighbors.
+        n_jobs : Optional[int], optional
+            Number of threads used when supported, by default None
+
+        Returns
+        -------
+        np.ndarray
+            (M, k) data indices sorted by distance.
+        """
+
+
+class CKDTreeIndex(NeighborsIndex):
+    """Scipy's cKDTree, radius search is done with a dual-tree traversal
+    of each block of queries, blocks are searched by parallel threads
+    """
+
+    def __init__(self, data: np.ndarray, **kwargs) -> None:
+        super().__init__(data, **kwargs)
+        self._tree = cKDTree(self.data, leafsize=self.leaf_size)
+
+    def _block_pairs(
+        self, X: np.ndarray, radius: float, start: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Radius pairs of a block of queries starting at `start`, the traversal releases the GIL"""
+        pairs = cKDTree(X).sparse_distance_matrix(
+            self._tree, radius, output_type="ndarray"
+        )
+        return pairs["i"] + start, pairs["j"], pairs["v"]
+
+    def radius_pairs(
+        self, X: np.ndarray, radius: float, n_jobs: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        n_blocks = min(n_threads(n_jobs), -(-len(X) // _MIN_THREAD_BLOCK_SIZE))
+        if n_blocks <= 1:
+            return self._block_pairs(X, radius, 0)
+
+        bounds = np.linspace(0, len(X), n_blocks + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=n_blocks) as executor:
+            blocks = executor.map(
+                lambda start, end: self._block_pairs(
+                    X[start:end], radius, start
+                ),
+                bounds[:-1],
+                bounds[1:],
+            )
+            return tuple(map(np.concatenate, zip(*blocks)))
+
+    def query(
+        self, X: np.ndarray, k: int, n_jobs: Optional[int] = None
+    ) -> np.ndarray:
+        # cKDTree pads missing neighbors with len(data) indices
+        self._check_k(k)
+        _, indices = self._tree.query(
+            X, k=k, workers=1 if n_jobs is None else n_jobs
+        )
+        return indices.reshape((len(X), k))
+
+
+class SklearnKDTreeIndex(NeighborsIndex):
+    """Scikit-learn's KDTree, used by `RadiusNeighborsRegressor`"""
+
+    def __init__(self, data: np.ndarray, **kwargs) -> None:
+        super().__init__(data, **kwargs)
+        # scikit-learn does not build trees of empty data
+        self._tree = (
+            KDTree(self.data, leaf_size=self.leaf_size)
+            if len(self.data) > 0
+            else None
+        )
+
+    def radius_pairs(
+        self, X: np.ndarray, radius: float, n_jobs: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._tree is None or len(X) == 0:
+            return _empty_pairs()
+        neigh_ind, neigh_dist = self._tree.query_radius(
+            X, radius, return_distance=True
+        )
+        lengths = np.fromiter(map(len, neigh_ind), dtype=int, count=len(X))
+        neigh_src = np.repeat(np.arange(len(X)), lengths)
+        if len(neigh_src) == 0:
+            return _empty_pairs()
+        return (
+            neigh_src,
+            np.concatenate(neigh_ind),
+            np.concatenate(neigh_dist),
+        )
+
+    def query(
+        self, X: np.ndarray, k: int, n_jobs: Optional[int] = None
+    ) -> np.ndarray:
+        self._check_k(k)
+        return self._tree.query(X, k=k, return_distance=False)
+
+
+class BruteForceIndex(NeighborsIndex):
+    """Blocked exhaustive search with NumPy, fastest for small frames"""
+
+    def _blocks(self, X: np.ndarray):
+        """Iterates over query blocks and their distances to every data point"""
+        block_size = max(1, _BRUTE_FORCE_BLOCK_SIZE // max(1, len(self.data)))
+        for start in range(0, len(X), block_size):
+            block = X[start : start + block_size]
+            diff = block[:, np.newaxis] - self.data[np.newaxis]
+            yield start, np.sqrt(np.square(diff).sum(axis=-1))
+
+    def radius_pairs(
+        self, X: np.ndarray, radius: float, n_jobs: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        neigh_src = [np.empty(0, dtype=int)]
+        neigh_dst = [np.empty(0, dtype=int)]
+        neigh_dist = [np.empty(0)]
+        for start, dist in self._blocks(X):
+            src, dst = np.nonzero(dist <= radius)
+            neigh_src.append(src + start)
+            neigh_dst.append(dst)
+            neigh_dist.append(dist[src, dst])
+        return (
+            np.concatenate(neigh_src),
+            np.concatenate(neigh_dst),
+            np.concatenate(neigh_dist),
+        )
+
+    def query(
+        self, X: np.ndarray, k: int, n_jobs: Optional[int] = None
+    ) -> np.ndarray:
+        self._check_k(k)
+        indices = np.empty((len(X), k), dtype=int)
+        for start, dist in self._blocks(X):
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            order = np.argsort(
+                np.take_along_axis(dist, nearest, axis=1), axis=1
+            )
+            indices[start : start + len(dist)] = np.take_along_axis(
+                nearest, order, axis=1
+            )
+        return indices
+
+
+class GridIndex(NeighborsIndex):
+    """Uniform grid (cell list) with hashed cells of the query radius size,
+    data is sorted by cell again whenever the radius changes.
+
+    Grids with too many cells to be hashed into int64 keys fall back to a
+    cKDTree, which also answers nearest neighbors queries.
+    """
+
+    def __init__(self, data: np.ndarray, **kwargs) -> None:
+        super().__init__(data, **kwargs)
+        self._cell_size = None
+        self._tree = None
+
+    def _ckdtree(self) -> CKDTreeIndex:
+        """cKDTree of the data, built on demand"""
+        if self._tree is None:
+            self._tree = CKDTreeIndex(self.data, leaf_size=self.leaf_size)
+        return self._tree
+
+    def _cell_coords(self, X: np.ndarray) -> np.ndarray:
+        """Integer grid coordinates of `X`, clipped to two cells around the grid so far queries never overflow"""
+        cells = np.floor((X - self._origin) / self._cell_size)
+        return np.clip(cells, -2, np.asarray(self._shape) + 1).astype(np.int64)
+
+    def _cell_keys(self, cells: np.ndarray) -> np.ndarray:
+        """Linear (hash) key of grid coordinates, assumes they are inside the grid"""
+        return np.ravel_multi_index(tuple(cells.T), self._shape)
+
+    def _build(self, cell_size: float) -> None:
+        """Sorts data by their grid cell, the grid shape is None when its keys would overflow"""
+        self._cell_size = cell_size
+        self._origin = self.data.min(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shape = (
+                np.floor((self.data.max(axis=0) - self._origin) / cell_size)
+                + 1
+            )
+
+        if not np.prod(shape) <= _GRID_MAX_CELLS:
+            self._shape = None
+            return
+
+        self._shape = tuple(shape.astype(np.int64))
+        keys = self._cell_keys(self._cell_coords(self.data))
+        self._order = np.argsort(keys, kind="stable")
+        self._keys, self._starts, counts = np.unique(
+            keys[self._order], return_index=True, return_counts=True
+        )
+        self._ends = self._starts + counts
+
+    def radius_pairs(
+        self, X: np.ndarray, radius: float, n_jobs: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if len(self.data) == 0 or len(X) == 0:
+            return _empty_pairs()
+
+        if radius != self._cell_size:
+            self._build(radius)
+
+        if self._shape is None:
+            return self._ckdtree().radius_pairs(X, radius, n_jobs=n_jobs)
+
+        X = as_float_array(X)
+        ndim = self.data.shape[1]
+        query_cells = self._cell_coords(X)
+
+        neigh_src = [np.empty(0, dtype=int)]
+        neigh_dst = [np.empty(0, dtype=int)]
+        neigh_dist = [np.empty(0)]
+
+        # candidates are filtered for each neighboring cell offset to bound memory
+        for offset in np.ndindex(*((3,) * ndim)):
+            cells = query_cells + (np.asarray(offset) - 1)
+            inside = np.all((cells >= 0) & (cells < self._shape), axis=1)
+            src = np.nonzero(inside)[0]
+            if len(src) == 0:
+                continue
+
+            keys = self._cell_keys(cells[src])
+            pos = np.minimum(
+                np.searchsorted(self._keys, keys), len(self._keys) - 1
+            )
+            found = self._keys[pos] == keys
+            src, pos = src[found], pos[found]
+            starts = self._starts[pos]
+            counts = self._ends[pos] - starts
+            total = counts.sum()
+            if total == 0:
+                continue
+
+            # expanding each (query, cell) into its cell points
+            src = np.repeat(src, counts)
+            shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+            dst = self._order[np.arange(total) + shifts]
+
+            dist = np.sqrt(np.square(X[src] - self.data[dst]).sum(axis=1))
+            within = dist <= radius
+            neigh_src.append(src[within])
+            neigh_dst.append(dst[within])
+            neigh_dist.append(dist[within])
+
+        return (
+            np.concatenate(neigh_src),
+            np.concatenate(neigh_dst),
+            np.concatenate(neigh_dist),
+        )
+
+    def query(
+        self, X: np.ndarray, k: int, n_jobs: Optional[int] = None
+    ) -> np.ndarray:
+        return self._ckdtree().query(X, k, n_jobs=n_jobs)
+
+
+BACKENDS = {
+    "ckdtree": CKDTreeIndex,
+    "kd_tree": SklearnKDTreeIndex,
+    "brute": BruteForceIndex,
+    "grid": GridIndex,
+}
+
+
+def select_backend(data: np.ndarray) -> str:
+    """Selects neighbors search backend from data size and dimensionality"""
+    if len(data) <= BRUTE_FORCE_MAX_SIZE or data.shape[1] > TREE_MAX_DIM:
+        return "brute"
+    return "ckdtree"
+
+
+def build_index(
+    data: np.ndarray, backend: str = "auto", **kwargs
+) -> NeighborsIndex:
+    """Builds a neighbors index of `data`.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (N, D) indexed coordinates.
+    backend : str, optional
+        One of "auto", "ckdtree", "kd_tree", "brute" or "grid", by default "auto"
+
+    Returns
+    -------
+    NeighborsIndex
+        Neighbors index.
+    """
+    if backend == "auto":
+        backend = select_backend(np.asarray(data))
+
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Neighbors backend must be 'auto' or one of {list(BACKENDS.keys())}. Found {backend}"
+        )
+
+    return BACKENDS[backend](data, **kwargs)